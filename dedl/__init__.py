@@ -0,0 +1,4 @@
+from pkgutil import extend_path
+
+# the use-case trees under usecase/data_preparation/src add their own modules to this package
+__path__ = extend_path(__path__, __name__)
@@ -0,0 +1,264 @@
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from datetime import date
+from itertools import groupby
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import cdsapi
+import dask.array
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray import DataArray, Dataset
+
+HOURS = [f'{h:02d}:00' for h in range(24)]
+MAX_DAYS_PER_REQUEST = 31
+MAX_REQUESTS_IN_FLIGHT = 4
+GRIB_DIR = Path('/tmp')
+# a daily fill is the write unit, so a day is one time chunk and never shares an object with another day
+WRITE_CHUNKS = (1, 100, 100)
+READ_CHUNKS = (100, 100, 100)
+# coverage is tracked per spatial chunk, 100 pixels of 0.1 degrees, i.e. 10 degree tiles
+TILE = WRITE_CHUNKS[1]
+TILE_DIMS = ('tile_latitude', 'tile_longitude')
+
+Bounds = Tuple[float, float, float, float]
+
+
+class Window(NamedTuple):
+    rows: slice
+    cols: slice
+
+    def pixels(self, ds: Dataset) -> Tuple[slice, slice]:
+        return (slice(self.rows.start * TILE, min(self.rows.stop * TILE, ds.sizes['latitude'])),
+                slice(self.cols.start * TILE, min(self.cols.stop * TILE, ds.sizes['longitude'])))
+
+    def area(self, ds: Dataset) -> List[float]:
+        rows, cols = self.pixels(ds)
+        lats, lons = ds['latitude'].values[rows], ds['longitude'].values[cols]
+        return [round(float(v), 3) for v in (lats[0], lons[0], lats[-1], lons[-1])]
+
+    def is_global(self, ds: Dataset) -> bool:
+        return self == full_window(ds)
+
+
+def tile_shape(n_lats: int, n_lons: int) -> Tuple[int, int]:
+    return -(-n_lats // TILE), -(-n_lons // TILE)
+
+
+def full_window(ds: Dataset) -> Window:
+    n_rows, n_cols = tile_shape(ds.sizes['latitude'], ds.sizes['longitude'])
+    return Window(slice(0, n_rows), slice(0, n_cols))
+
+
+def _box(window: Optional[Window], rows: np.ndarray, cols: np.ndarray) -> Window:
+    # the tile box around the given tile indices, relative to the window they were taken from
+    row0, col0 = (window.rows.start, window.cols.start) if window is not None else (0, 0)
+    return Window(slice(int(row0 + rows.min()), int(row0 + rows.max() + 1)),
+                  slice(int(col0 + cols.min()), int(col0 + cols.max() + 1)))
+
+
+def tile_window(ds: Dataset, bounds: Optional[Bounds] = None) -> Window:
+    if bounds is None:
+        return full_window(ds)
+    min_x, min_y, max_x, max_y = bounds
+    lats, lons = ds['latitude'].values, ds['longitude'].values
+    rows = np.flatnonzero((lats >= min_y) & (lats <= max_y))
+    cols = np.flatnonzero((lons >= min_x) & (lons <= max_x))
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError(f"Bounds {bounds} do not intersect the cache grid.")
+    return _box(None, rows // TILE, cols // TILE)
+
+
+def empty_tile_coverage(n_days: int, n_lats: int, n_lons: int) -> dask.array.Array:
+    return dask.array.zeros((n_days, *tile_shape(n_lats, n_lons)), chunks=(100, -1, -1), dtype=np.uint8)
+
+
+def cache_encoding(variable: str, n_lats: int, n_lons: int, chunks=WRITE_CHUNKS) -> dict:
+    return {variable: {'chunks': chunks}, 'covered': {'chunks': chunks[:1]},
+            'tile_covered': {'chunks': (chunks[0], *tile_shape(n_lats, n_lons))}}
+
+
+def ensure_tile_coverage(store: Path) -> Dataset:
+    ds = xr.open_zarr(store)
+    if 'tile_covered' not in ds:
+        # caches from before tile tracking only knew whole days, which cover every tile
+        tiles = empty_tile_coverage(ds.sizes['time'], ds.sizes['latitude'], ds.sizes['longitude'])
+        tiles = tiles + ds['covered'].data[:, None, None].astype(np.uint8)
+        Dataset({'tile_covered': (('time', *TILE_DIMS), tiles)}).to_zarr(
+            store, mode='a', encoding={'tile_covered': {'chunks': (1, *tiles.shape[1:])}})
+        ds = xr.open_zarr(store)
+    return ds
+
+
+def missing_tiles(ds: Dataset, start, end, bounds: Optional[Bounds] = None) -> Dict[date, Window]:
+    window = tile_window(ds, bounds)
+    covered = ds['tile_covered'].loc[start:end].isel({TILE_DIMS[0]: window.rows, TILE_DIMS[1]: window.cols}).load()
+    missing = {}
+    for when, tiles in zip(pd.to_datetime(covered['time'].values), covered.values):
+        rows, cols = np.nonzero(tiles == 0)
+        if len(rows):
+            # one box per day, CDS takes a single rectangle per request
+            missing[when.date()] = _box(window, rows, cols)
+    return missing
+
+
+def plan_requests(missing: Dict[date, Window], max_days: int = MAX_DAYS_PER_REQUEST) \
+        -> List[Tuple[List[date], Window]]:
+    # a CDS request takes one year and month with a list of days and one area, so batches share both
+    def key(d: date):
+        window = missing[d]
+        return d.year, d.month, window.rows.start, window.rows.stop, window.cols.start, window.cols.stop
+
+    batches = []
+    for _, group in groupby(sorted(missing, key=lambda d: (key(d), d)), key=key):
+        group = list(group)
+        batches.extend((group[i:i + max_days], missing[group[0]]) for i in range(0, len(group), max_days))
+    return batches
+
+
+def request_grib(client, variable: str, days: Sequence[date], area: Sequence[float],
+                 out_dir: Path = GRIB_DIR) -> Path:
+    first, last = days[0], days[-1]
+    box = '_'.join(f'{v:g}' for v in area)
+    out_file = Path(out_dir) / f'{variable}_era5land_{first:%Y%m%d}-{last:%Y%m%d}_{len(days)}_{box}.grib'
+    if out_file.exists():
+        return out_file
+    partial = out_file.with_suffix('.grib.part')
+    client.retrieve(
+        'reanalysis-era5-land',
+        {
+            'product_type': 'reanalysis',
+            'format': 'grib',
+            'time': HOURS,
+            'day': [d.day for d in days],
+            'month': first.month,
+            'year': first.year,
+            'area': list(area),
+
+            'variable': variable,
+        },
+        str(partial))
+    partial.rename(out_file)
+    return out_file
+
+
+def retrieve_days(cache_ds: Dataset, missing: Dict[date, Window], variable: str,
+                  write: Callable[[Path, List[date], Window], None], client_factory: Callable = cdsapi.Client,
+                  max_days: int = MAX_DAYS_PER_REQUEST, max_in_flight: int = MAX_REQUESTS_IN_FLIGHT,
+                  out_dir: Path = GRIB_DIR) -> None:
+    batches = plan_requests(missing, max_days)
+    if not batches:
+        return
+
+    def download(batch: List[date], window: Window) -> Path:
+        return request_grib(client_factory(), variable, batch, window.area(cache_ds), out_dir)
+
+    # the calling thread is the only writer; it decodes and stores each batch while the others are still queued at CDS
+    with ThreadPoolExecutor(max_in_flight, thread_name_prefix="cds-request") as pool:
+        pending = {pool.submit(download, *batch): batch for batch in batches}
+        try:
+            for future in as_completed(pending):
+                write(future.result(), *pending[future])
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def _time_chunk(ds: Dataset, name: str) -> int:
+    return ds[name].encoding.get('chunks', (1,))[0]
+
+
+@contextmanager
+def chunk_locks(store: Path, ds: Dataset, names: Sequence[str], indices: Iterable[int]):
+    # one lock file per time chunk; taking them in sorted order keeps concurrent fills free of deadlocks
+    lock_dir = Path(f'{store}.locks')
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    keys = sorted({(name, int(i) // _time_chunk(ds, name)) for name in names for i in indices})
+    with ExitStack() as stack:
+        for name, chunk in keys:
+            lock = stack.enter_context(open(lock_dir / f'{name}.{chunk}.lock', 'w'))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _runs(indices: np.ndarray) -> List[np.ndarray]:
+    return np.split(np.arange(len(indices)), np.flatnonzero(np.diff(indices) != 1) + 1)
+
+
+def write_days(store: Path, cache_ds: Dataset, variable: str, daily: DataArray,
+               window: Optional[Window] = None) -> None:
+    window = window or full_window(cache_ds)
+    rows, cols = window.pixels(cache_ds)
+    # the retrieved area is snapped onto the cache grid; pixels it does not reach stay empty
+    daily = daily.reindex(latitude=cache_ds['latitude'].values[rows], longitude=cache_ds['longitude'].values[cols],
+                          method='nearest', tolerance=0.05)
+    indices = cache_ds.indexes['time'].get_indexer(daily['time'].values, method='nearest')
+    order = np.argsort(indices)
+    indices, values = indices[order], daily.values[order].astype(np.float32)
+    names = [variable, 'tile_covered'] + (['covered'] if window.is_global(cache_ds) else [])
+    tiles = (window.rows.stop - window.rows.start, window.cols.stop - window.cols.start)
+    # consecutive days go out as one region write
+    for run in _runs(indices):
+        t_i = indices[run[0]]
+        update_ds = Dataset({variable: (('time', 'latitude', 'longitude'), values[run]),
+                             'tile_covered': (('time', *TILE_DIMS), np.ones((len(run), *tiles), dtype=np.uint8))})
+        if 'covered' in names:
+            update_ds['covered'] = ('time',), np.ones(len(run), dtype=np.uint8)
+        with chunk_locks(store, cache_ds, names, indices[run]):
+            update_ds.to_zarr(store, region={
+                'time': slice(t_i, t_i + len(run)),
+                'latitude': rows,
+                'longitude': cols,
+                TILE_DIMS[0]: window.rows,
+                TILE_DIMS[1]: window.cols
+            })
+
+
+def sync_replica(store: Path, replica: Path, start: Optional[date] = None, end: Optional[date] = None,
+                 bounds: Optional[Bounds] = None, chunks=READ_CHUNKS) -> Dataset:
+    # the replica holds the same days in long time chunks for series reads; only tiles with new days are copied
+    source = ensure_tile_coverage(store)
+    timed = [name for name in source.data_vars if 'time' in source[name].dims]
+    if not replica.exists():
+        # built from empty arrays, as rechunking the source would pull the whole cache into the graph
+        sizes = dict(zip(('time', 'latitude', 'longitude'), chunks))
+        template = Dataset(coords=source[timed].coords)
+        for name in timed:
+            array = source[name]
+            fill = dask.array.zeros if name in ('covered', 'tile_covered') else dask.array.empty
+            template[name] = (array.dims, fill(array.shape, dtype=array.dtype,
+                                               chunks=tuple(sizes.get(dim, -1) for dim in array.dims)), array.attrs)
+            template[name].encoding = dict(array.encoding)
+        variable = next(name for name in timed if 'latitude' in source[name].dims)
+        template.to_zarr(replica, compute=False,
+                         encoding=cache_encoding(variable, source.sizes['latitude'], source.sizes['longitude'], chunks))
+        source.drop_dims('time').to_zarr(replica, mode='a')
+    target = ensure_tile_coverage(replica)
+
+    window = tile_window(source, bounds)
+    select = {TILE_DIMS[0]: window.rows, TILE_DIMS[1]: window.cols}
+    have = source['tile_covered'].loc[start:end].isel(select).load()
+    stale = (have != target['tile_covered'].loc[start:end].isel(select).load()).values
+    indices = source.indexes['time'].get_indexer(have['time'].values)
+    time_chunk = _time_chunk(target, 'tile_covered')
+    for chunk, members in groupby(np.flatnonzero(stale.any(axis=(1, 2))), key=lambda i: indices[i] // time_chunk):
+        days = slice(chunk * time_chunk, min((chunk + 1) * time_chunk, source.sizes['time']))
+        _, rows, cols = np.nonzero(stale[list(members)])
+        tiles = _box(window, rows, cols)
+        pixels = tiles.pixels(source)
+        block = source[timed].isel(time=days, latitude=pixels[0], longitude=pixels[1],
+                                   **{TILE_DIMS[0]: tiles.rows, TILE_DIMS[1]: tiles.cols})
+        block = block.drop_vars(list(block.coords)).chunk({'time': -1, 'latitude': chunks[1], 'longitude': chunks[2]})
+        # each tile_covered chunk gets exactly one dask task, under the lock, so its partial write is safe
+        with chunk_locks(replica, target, timed, range(days.start, days.stop)):
+            block.to_zarr(replica, region={'time': days, 'latitude': pixels[0], 'longitude': pixels[1],
+                                           TILE_DIMS[0]: tiles.rows, TILE_DIMS[1]: tiles.cols}, safe_chunks=False)
+    return xr.open_zarr(replica)
+
+
+def open_grib(path: Path, variable: str) -> DataArray:
+    return xr.open_dataset(path, backend_kwargs=dict(indexpath=''))[variable]
@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
+
+import pandas as pd
+import panel as pn
+import param as pm
+from holoviews import DynamicMap, Element
+from holoviews.streams import RangeXY
+from xarray import DataArray
+
+from dedl.pyramid import Pyramid
+
+FRAME_CACHE_SIZE = 64
+PRERENDER_WORKERS = 4
+
+
+class FrameCache:
+    def __init__(self, maxsize: int = FRAME_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._frames
+
+    def get(self, key: Hashable, factory: Callable):
+        with self._lock:
+            future = self._frames.get(key)
+            owner = future is None
+            if owner:
+                # concurrent requests for the same frame wait on the first one instead of rendering it again
+                future = self._frames[key] = Future()
+                self.misses += 1
+                while len(self._frames) > self.maxsize:
+                    self._frames.popitem(last=False)
+            else:
+                self._frames.move_to_end(key)
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(factory())
+            except BaseException as e:
+                with self._lock:
+                    if self._frames.get(key) is future:
+                        del self._frames[key]
+                future.set_exception(e)
+        return future.result()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+
+
+class TimeSliderExplorer(pm.Parameterized):
+    time = pm.Selector(objects=[])
+
+    def __init__(self, da: DataArray, dim: str, render: Callable[[DataArray], Element],
+                 pyramid: Optional[Pyramid] = None, width: int = 512, height: int = 512, label: str = 'Time',
+                 cache_size: int = FRAME_CACHE_SIZE, prerender: bool = True, load: bool = True, **params):
+        super().__init__(**params)
+        steps = [pd.to_datetime(t).date() for t in da[dim].values]
+        self.param.time.objects = steps
+        self.param.time.label = label
+        self.time = steps[0]
+        self.frames = FrameCache(cache_size)
+        self._da = da
+        self._dim = dim
+        self._render = render
+        self._pyramid = pyramid
+        self._size = (width, height)
+        self._load = load
+        if prerender:
+            self.prerender()
+
+    def _viewport(self, x_range, y_range):
+        if self._pyramid is None or x_range is None or y_range is None or None in (*x_range, *y_range):
+            return None, None
+        if self._pyramid.level_for(x_range, y_range, *self._size) == len(self._pyramid.levels) - 1:
+            # the coarsest level is small enough to hand over whole, so every zoomed-out view shares one frame
+            return None, None
+        return tuple(x_range), tuple(y_range)
+
+    def _step(self, when, x_range, y_range) -> DataArray:
+        if self._pyramid is None:
+            step = self._da.sel({self._dim: when}, method='nearest')
+            return step.load() if self._load else step
+        return self._pyramid.window(x_range, y_range, *self._size, **{self._dim: when})
+
+    def frame(self, when, x_range=None, y_range=None) -> Element:
+        x_range, y_range = self._viewport(x_range, y_range)
+        return self.frames.get((when, x_range, y_range), lambda: self._render(self._step(when, x_range, y_range)))
+
+    def prerender(self, workers: int = PRERENDER_WORKERS) -> None:
+        # runs in the background so the widget shows up right away; a slider move waits only for its own frame
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="prerender")
+        for when in self.param.time.objects[:self.frames.maxsize]:
+            pool.submit(self.frame, when)
+        pool.shutdown(wait=False)
+
+    @pm.depends('time')
+    def view(self, x_range=None, y_range=None) -> Element:
+        return self.frame(self.time, x_range, y_range)
+
+    def map(self) -> DynamicMap:
+        return DynamicMap(self.view, streams=[RangeXY()] if self._pyramid is not None else [])
+
+    def slider(self, width: int = 512) -> pn.widgets.DiscreteSlider:
+        return pn.widgets.DiscreteSlider.from_param(self.param.time, width=width)
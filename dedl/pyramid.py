@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+from dask.base import tokenize
+from holoviews import DynamicMap, Image
+from holoviews.streams import RangeXY
+from xarray import DataArray
+
+TILE_SIZE = 256
+# below this many pixels per step Bokeh copes fine with the full array
+MIN_PIXELS = 2048 * 2048
+PYRAMID_DIR = Path(os.environ.get("DEDL_PYRAMID_DIR", Path(tempfile.gettempdir()) / "dedl-pyramids"))
+# pyramids kept in PYRAMID_DIR; older ones are removed when a new one is built
+MAX_PYRAMIDS = int(os.environ.get("DEDL_MAX_PYRAMIDS", 8))
+
+_SPATIAL_DIMS = (("x", "y"), ("longitude", "latitude"), ("lon", "lat"))
+_AGGREGATIONS = ("mean", "majority", "max", "nearest")
+
+# pyramids opened by this process, never evicted from under a live plot
+_in_use = set()
+
+
+def _spatial_dims(da: DataArray) -> Tuple[str, str]:
+    for x_dim, y_dim in _SPATIAL_DIMS:
+        if x_dim in da.dims and y_dim in da.dims:
+            return x_dim, y_dim
+    raise ValueError(f"Cannot build a pyramid without a regular grid, got dimensions {da.dims}.")
+
+
+def _halve(da: DataArray, how: str, x_dim: str, y_dim: str) -> DataArray:
+    coarse = da.coarsen({y_dim: 2, x_dim: 2}, boundary='trim')
+    if how == 'mean':
+        return coarse.mean()
+    if how == 'max':
+        return coarse.max()
+    if how == 'majority':
+        share = coarse.mean()
+        return (share >= 0.5).where(share.notnull()).astype(np.float32)
+    if how == 'nearest':
+        # the picked pixel keeps its own coordinates, so it is drawn where its value was sampled
+        return da.isel({y_dim: slice(0, da.sizes[y_dim] // 2 * 2, 2), x_dim: slice(0, da.sizes[x_dim] // 2 * 2, 2)})
+    raise ValueError(f"Unknown aggregation {how!r}, expected one of {_AGGREGATIONS}.")
+
+
+def _range_slice(coords: np.ndarray, lo: float, hi: float) -> slice:
+    lo, hi = min(lo, hi), max(lo, hi)
+    return slice(hi, lo) if coords[0] > coords[-1] else slice(lo, hi)
+
+
+class Pyramid:
+    def __init__(self, path: Path, levels: List[DataArray], how: str):
+        self.path = Path(path)
+        self.levels = levels
+        self.how = how
+        self._dims = _spatial_dims(levels[0])
+        self._resolutions = [float(abs(l[self._dims[0]][1] - l[self._dims[0]][0])) for l in levels]
+
+    @classmethod
+    def open(cls, path: Path) -> "Pyramid":
+        path = Path(path)
+        meta = json.loads((path / "pyramid.json").read_text())
+        # the modification time of pyramid.json orders eviction
+        os.utime(path / "pyramid.json")
+        _in_use.add(path.resolve())
+        levels = []
+        for i in range(meta["levels"]):
+            level = xr.open_zarr(path / str(i), consolidated=True)[meta["name"]]
+            levels.append(level.rio.write_crs(meta["crs"]) if meta["crs"] else level)
+        return cls(path, levels, meta["how"])
+
+    def level_for(self, x_range, y_range, width: int, height: int) -> int:
+        target = min(abs(x_range[1] - x_range[0]) / width, abs(y_range[1] - y_range[0]) / height)
+        fitting = [i for i, res in enumerate(self._resolutions) if res <= target]
+        return fitting[-1] if fitting else 0
+
+    def window(self, x_range=None, y_range=None, width: int = 512, height: int = 512, **indexers) -> DataArray:
+        x_dim, y_dim = self._dims
+        if x_range is None or y_range is None or None in (*x_range, *y_range):
+            level = self.levels[-1]
+        else:
+            level = self.levels[self.level_for(x_range, y_range, width, height)]
+            level = level.sel({x_dim: _range_slice(level[x_dim].values, *x_range),
+                               y_dim: _range_slice(level[y_dim].values, *y_range)})
+            if level.sizes[x_dim] < 2 or level.sizes[y_dim] < 2:
+                # panned off the data, Bokeh still needs a drawable image
+                level = self.levels[-1]
+        if indexers:
+            level = level.sel(indexers, method='nearest')
+        return level.load()
+
+    def remove(self) -> None:
+        _in_use.discard(self.path.resolve())
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _evict(directory: Path, keep: int) -> None:
+    built = sorted(directory.glob("*/pyramid.json"), key=lambda f: f.stat().st_mtime, reverse=True)
+    for meta in built[keep:]:
+        if meta.parent.resolve() not in _in_use:
+            shutil.rmtree(meta.parent, ignore_errors=True)
+
+
+def build_pyramid(da: DataArray, how: str = 'mean', path: Optional[Path] = None, tile_size: int = TILE_SIZE,
+                  overwrite: bool = False) -> Pyramid:
+    if how not in _AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {how!r}, expected one of {_AGGREGATIONS}.")
+    x_dim, y_dim = _spatial_dims(da)
+    name = da.name or 'value'
+    if path is None:
+        path = PYRAMID_DIR / f"{name}-{how}-{tokenize(da, tile_size)}"
+        if not (path / "pyramid.json").exists():
+            _evict(PYRAMID_DIR, MAX_PYRAMIDS - 1)
+    path = Path(path)
+    if (path / "pyramid.json").exists() and not overwrite:
+        return Pyramid.open(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+    crs = da.rio.crs.to_string() if da.rio.crs is not None else None
+    chunks = {d: 1 for d in da.dims}
+    chunks.update({y_dim: tile_size, x_dim: tile_size})
+    level, n = da.rename(name), 0
+    while True:
+        ds = level.chunk({d: c for d, c in chunks.items() if d in level.dims}).to_dataset()
+        for variable in ds.variables.values():
+            variable.encoding = {}
+        ds.to_zarr(path / str(n), mode='w', consolidated=True)
+        level = xr.open_zarr(path / str(n), consolidated=True)[name]
+        n += 1
+        if max(level.sizes[y_dim], level.sizes[x_dim]) <= tile_size:
+            break
+        level = _halve(level, how, x_dim, y_dim)
+
+    # written last so an interrupted build is redone rather than reused
+    (path / "pyramid.json").write_text(json.dumps({"name": name, "how": how, "crs": crs, "levels": n}))
+    return Pyramid.open(path)
+
+
+def as_pyramid(da: DataArray, how: str = 'mean', **kwargs) -> Optional[Pyramid]:
+    x_dim, y_dim = _spatial_dims(da)
+    if da.sizes[y_dim] * da.sizes[x_dim] <= MIN_PIXELS:
+        return None
+    return build_pyramid(da, how, **kwargs)
+
+
+def dynamic_image(pyramid: Pyramid, width: int = 512, height: int = 512, **indexers) -> DynamicMap:
+    def tiles(x_range=None, y_range=None):
+        return Image(pyramid.window(x_range, y_range, width, height, **indexers))
+
+    return DynamicMap(tiles, streams=[RangeXY()])
+
+
+# datashader's downsampling counterpart of each overview aggregation
+_DOWNSAMPLERS = {'mean': 'mean', 'majority': 'mode', 'max': 'max', 'nearest': 'first'}
+
+
+def rasterized(element, how: str = 'mean', width: int = 512, height: int = 512) -> DynamicMap:
+    from holoviews.operation.datashader import rasterize
+    # re-aggregates on every zoom from the (possibly Dask-backed) array, the browser only gets screen-sized images
+    return rasterize(element, aggregator=_DOWNSAMPLERS[how], width=width, height=height, dynamic=True)
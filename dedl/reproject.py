@@ -0,0 +1,318 @@
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import dask.array
+import numpy as np
+import xarray as xr
+from affine import Affine
+from pyproj import CRS, Transformer
+from rasterio.enums import Resampling
+from rasterio.warp import calculate_default_transform, reproject as gdal_reproject
+from xarray import DataArray
+
+PLAN_DIR = Path(os.environ.get("DEDL_REPROJECT_PLAN_DIR", Path(tempfile.gettempdir()) / "dedl-reproject-plans"))
+MAX_PLANS_IN_MEMORY = 16
+# bumped whenever plans change meaning, so stale ones on disk are not reused
+PLAN_VERSION = 2
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+@dataclass
+class WarpPlan:
+    transform: Affine
+    shape: Tuple[int, int]
+    indices: np.ndarray
+    weights: np.ndarray
+
+    def apply(self, data: np.ndarray, src_nodata=None, dst_nodata=np.nan) -> np.ndarray:
+        leading = data.shape[:-2]
+        flat = data.reshape(-1, data.shape[-2] * data.shape[-1])
+        masked = src_nodata is not None and not (isinstance(src_nodata, float) and np.isnan(src_nodata))
+        dtype = output_dtype(data.dtype, dst_nodata)
+        if self.indices.shape[0] == 1:
+            out = flat[:, np.maximum(self.indices[0], 0)].astype(dtype, copy=False)
+            # per band, since each band has its own nodata pixels
+            missing = np.broadcast_to(self.indices[0] < 0, out.shape)
+            if masked:
+                missing = missing | (out == src_nodata)
+            out[missing] = dst_nodata
+            if data.dtype.kind == 'f' and not np.isnan(dst_nodata):
+                out[np.isnan(out)] = dst_nodata
+            return out.reshape(*leading, *self.shape)
+
+        missing = np.isnan(flat) if data.dtype.kind == 'f' else np.zeros(flat.shape, bool)
+        if masked:
+            missing |= flat == src_nodata
+        work = np.result_type(data.dtype, np.float32)
+        out = np.zeros((flat.shape[0], self.indices.shape[1]), work)
+        if not missing.any():
+            # weights of off-grid neighbours are already zero and the rest renormalised, so a plain weighted sum
+            for indices, weights in zip(self.indices, self.normalised_weights):
+                values = flat[:, np.maximum(indices, 0)].astype(work, copy=False)
+                out += np.multiply(values, weights, out=values)
+            return _filled(out, np.broadcast_to(~self.covered, out.shape), dtype, dst_nodata).reshape(
+                *leading, *self.shape)
+
+        # masking the (small) source once lets every neighbour be a plain gather and multiply-add
+        filled = np.where(missing, 0, flat).astype(work, copy=False)
+        present = (~missing).astype(work)
+        total = np.zeros_like(out)
+        for indices, weights in zip(self.indices, self.weights):
+            safe = np.maximum(indices, 0)
+            out += filled[:, safe] * weights
+            total += present[:, safe] * weights
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out /= total
+        # like GDAL, the valid neighbours are renormalised, but a pixel whose own source pixel is missing stays empty
+        empty = (total == 0) | missing[:, np.maximum(self.containing, 0)]
+        return _filled(out, empty, dtype, dst_nodata).reshape(*leading, *self.shape)
+
+    @cached_property
+    def covered(self) -> np.ndarray:
+        return self.weights.sum(axis=0) > 0
+
+    @cached_property
+    def containing(self) -> np.ndarray:
+        # the neighbour with the largest bilinear weight is the source pixel the destination centre falls in
+        return self.indices[np.argmax(self.weights, axis=0), np.arange(self.indices.shape[1])]
+
+    @cached_property
+    def normalised_weights(self) -> np.ndarray:
+        total = self.weights.sum(axis=0)
+        return np.divide(self.weights, total, out=np.zeros_like(self.weights), where=total > 0)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.npz")
+        np.savez(tmp, transform=np.array(self.transform.to_gdal()), shape=np.array(self.shape),
+                 indices=self.indices, weights=self.weights)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "WarpPlan":
+        with np.load(path) as f:
+            return cls(Affine.from_gdal(*f["transform"]), tuple(int(s) for s in f["shape"]), f["indices"],
+                       f["weights"])
+
+
+@dataclass
+class GdalWarp:
+    # the resamplings the plans do not reproduce are left to GDAL, behind the same interface
+    src_crs: str
+    src_transform: Affine
+    dst_crs: str
+    transform: Affine
+    shape: Tuple[int, int]
+    resampling: Resampling
+
+    def apply(self, data: np.ndarray, src_nodata=None, dst_nodata=np.nan) -> np.ndarray:
+        leading = data.shape[:-2]
+        bands = data.reshape(-1, *data.shape[-2:])
+        out = np.full((bands.shape[0], *self.shape), dst_nodata, output_dtype(data.dtype, dst_nodata))
+        # one band at a time, since GDAL only masks a pixel that is nodata in every band it warps together
+        for band, dst in zip(bands, out):
+            gdal_reproject(band, dst, src_transform=self.src_transform, src_crs=self.src_crs, src_nodata=src_nodata,
+                           dst_transform=self.transform, dst_crs=self.dst_crs, dst_nodata=dst_nodata,
+                           resampling=self.resampling)
+        return out.reshape(*leading, *self.shape)
+
+
+def output_dtype(dtype, fill) -> np.dtype:
+    # the source dtype, as GDAL keeps it, unless the fill value does not fit
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f' or not np.isnan(fill) and np.array(fill).astype(dtype) == fill:
+        return dtype
+    return np.result_type(dtype, np.float32)
+
+
+def _filled(out: np.ndarray, empty: np.ndarray, dtype, dst_nodata) -> np.ndarray:
+    if np.dtype(dtype).kind in 'iu':
+        # GDAL rounds interpolated values half up
+        info = np.iinfo(dtype)
+        out = np.clip(np.floor(out + 0.5), info.min, info.max)
+    out = out.astype(dtype, copy=False)
+    out[empty] = dst_nodata
+    return out
+
+
+def _dst_grid(src_crs, src_transform: Affine, src_shape, dst_crs, resolution):
+    height, width = src_shape
+    left, top = src_transform * (0, 0)
+    right, bottom = src_transform * (width, height)
+    return calculate_default_transform(src_crs, dst_crs, width, height, min(left, right), min(top, bottom),
+                                       max(left, right), max(top, bottom), resolution=resolution)
+
+
+def _plan_key(src_crs, src_transform: Affine, src_shape, dst_crs, resolution, resampling: Resampling) -> str:
+    token = repr((PLAN_VERSION, CRS.from_user_input(src_crs).to_wkt(), tuple(src_transform)[:6], tuple(src_shape),
+                  CRS.from_user_input(dst_crs).to_wkt(), resolution, resampling.name))
+    return hashlib.sha1(token.encode()).hexdigest()
+
+
+def _compute_plan(src_crs, src_transform: Affine, src_shape, dst_crs, resolution, resampling: Resampling) -> WarpPlan:
+    height, width = src_shape
+    dst_transform, dst_width, dst_height = _dst_grid(src_crs, src_transform, src_shape, dst_crs, resolution)
+
+    cols, rows = np.meshgrid(np.arange(dst_width) + 0.5, np.arange(dst_height) + 0.5)
+    xs, ys = dst_transform * (cols.ravel(), rows.ravel())
+    src_xs, src_ys = Transformer.from_crs(dst_crs, src_crs, always_xy=True).transform(xs, ys)
+    u, v = ~src_transform * (np.asarray(src_xs), np.asarray(src_ys))
+
+    if resampling == Resampling.nearest:
+        c, r = np.floor(u).astype(np.int64), np.floor(v).astype(np.int64)
+        inside = (c >= 0) & (c < width) & (r >= 0) & (r < height) & np.isfinite(u) & np.isfinite(v)
+        indices = np.where(inside, r * width + c, -1)[None]
+        weights = inside[None].astype(np.float32)
+    elif resampling == Resampling.bilinear:
+        # GDAL leaves destination pixels whose centre falls outside the source empty
+        centre = (u >= 0) & (u < width) & (v >= 0) & (v < height)
+        # distances to the surrounding source pixel centres
+        u, v = u - 0.5, v - 0.5
+        c0, r0 = np.floor(u), np.floor(v)
+        du, dv = (u - c0).astype(np.float32), (v - r0).astype(np.float32)
+        c0, r0 = c0.astype(np.int64), r0.astype(np.int64)
+        indices, weights = [], []
+        for dr, dc, w in ((0, 0, (1 - dv) * (1 - du)), (0, 1, (1 - dv) * du), (1, 0, dv * (1 - du)), (1, 1, dv * du)):
+            r, c = r0 + dr, c0 + dc
+            inside = (c >= 0) & (c < width) & (r >= 0) & (r < height)
+            indices.append(np.where(inside, r * width + c, -1))
+            weights.append(np.where(inside & centre, w, 0).astype(np.float32))
+        indices, weights = np.stack(indices), np.stack(weights)
+    else:
+        raise NotImplementedError(resampling)
+    return WarpPlan(dst_transform, (dst_height, dst_width), indices, weights)
+
+
+def warp_plan(src_crs, src_transform: Affine, src_shape, dst_crs, resolution=None,
+              resampling: Resampling = Resampling.nearest, cache_dir: Optional[Path] = PLAN_DIR) -> WarpPlan:
+    key = _plan_key(src_crs, src_transform, src_shape, dst_crs, resolution, resampling)
+    with _plans_lock:
+        if key in _plans:
+            _plans.move_to_end(key)
+            return _plans[key]
+    path = Path(cache_dir) / f"{key}.npz" if cache_dir is not None else None
+    if path is not None and path.exists():
+        plan = WarpPlan.load(path)
+    else:
+        plan = _compute_plan(src_crs, src_transform, src_shape, dst_crs, resolution, resampling)
+        if path is not None:
+            plan.save(path)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > MAX_PLANS_IN_MEMORY:
+            _plans.popitem(last=False)
+    return plan
+
+
+def _prepare(da: DataArray, dst_crs, resolution, resampling: Resampling, nodata, cache_dir):
+    x_dim, y_dim = da.rio.x_dim, da.rio.y_dim
+    other = [d for d in da.dims if d not in (x_dim, y_dim)]
+    src = da.transpose(*other, y_dim, x_dim)
+    src_transform, src_shape = src.rio.transform(recalc=True), (src.sizes[y_dim], src.sizes[x_dim])
+    transform, width, height = _dst_grid(da.rio.crs, src_transform, src_shape, dst_crs, resolution)
+    # GDAL widens the bilinear kernel when downsampling, which the plans do not reproduce
+    if resampling == Resampling.nearest or resampling == Resampling.bilinear and \
+            height >= src_shape[0] and width >= src_shape[1]:
+        plan = warp_plan(da.rio.crs, src_transform, src_shape, dst_crs, resolution, resampling, cache_dir)
+    else:
+        plan = GdalWarp(da.rio.crs, src_transform, dst_crs, transform, (height, width), resampling)
+    src_nodata = da.rio.nodata
+    dst_nodata = nodata if nodata is not None else src_nodata if src_nodata is not None else \
+        np.nan if da.dtype.kind == 'f' or resampling != Resampling.nearest else 0
+    return src, other, plan, src_nodata, dst_nodata
+
+
+def _wrap(data, da: DataArray, src: DataArray, other, plan: Union[WarpPlan, GdalWarp], dst_crs,
+          dst_nodata) -> DataArray:
+    x_dim, y_dim = da.rio.x_dim, da.rio.y_dim
+    height, width = plan.shape
+    xs, _ = plan.transform * (np.arange(width) + 0.5, np.zeros(width))
+    _, ys = plan.transform * (np.zeros(height), np.arange(height) + 0.5)
+    coords = {name: c for name, c in src.coords.items() if not set(c.dims) & {x_dim, y_dim} and name != 'spatial_ref'}
+    coords.update({'y': ys, 'x': xs})
+    out = xr.DataArray(data, coords=coords, dims=(*other, 'y', 'x'), name=da.name, attrs=dict(da.attrs))
+    out = out.transpose(*[{x_dim: 'x', y_dim: 'y'}.get(d, d) for d in da.dims])
+    out.rio.write_transform(plan.transform, inplace=True)
+    out.rio.write_crs(dst_crs, inplace=True)
+    out.rio.write_nodata(dst_nodata, encoded=False, inplace=True)
+    return out
+
+
+def reproject(da: DataArray, dst_crs, resolution: Optional[Union[float, Tuple[float, float]]] = None,
+              resampling: Resampling = Resampling.nearest, nodata=None,
+              cache_dir: Optional[Path] = PLAN_DIR) -> DataArray:
+    src, other, plan, src_nodata, dst_nodata = _prepare(da, dst_crs, resolution, resampling, nodata, cache_dir)
+    data = plan.apply(np.asarray(src.values), src_nodata, dst_nodata)
+    return _wrap(data, da, src, other, plan, dst_crs, dst_nodata)
+
+
+def _warp_tile(window: np.ndarray, plan: Union[WarpPlan, GdalWarp], src_nodata, dst_nodata) -> np.ndarray:
+    return plan.apply(window, src_nodata, dst_nodata)
+
+
+def _tile_plans(plan: WarpPlan, width: int, tile: int):
+    # each tile's plan indexes the source window it samples; it enters the graph once as its own key
+    dst_height, dst_width = plan.shape
+    indices = plan.indices.reshape(-1, dst_height, dst_width)
+    weights = plan.weights.reshape(-1, dst_height, dst_width)
+    for r0 in range(0, dst_height, tile):
+        r1 = min(r0 + tile, dst_height)
+        for c0 in range(0, dst_width, tile):
+            c1 = min(c0 + tile, dst_width)
+            tile_indices = indices[:, r0:r1, c0:c1].reshape(indices.shape[0], -1)
+            valid = tile_indices >= 0
+            if not valid.any():
+                yield (r1 - r0, c1 - c0), None, None
+                continue
+            src_rows, src_cols = np.divmod(tile_indices[valid], width)
+            top, bottom, left, right = src_rows.min(), src_rows.max() + 1, src_cols.min(), src_cols.max() + 1
+            local = np.full(tile_indices.shape, -1, np.int64)
+            local[valid] = (src_rows - top) * (right - left) + (src_cols - left)
+            tile_plan = WarpPlan(Affine.identity(), (r1 - r0, c1 - c0), local,
+                                 weights[:, r0:r1, c0:c1].reshape(weights.shape[0], -1))
+            yield (r1 - r0, c1 - c0), (slice(top, bottom), slice(left, right)), dask.delayed(tile_plan, pure=True)
+
+
+def reproject_tiled(da: DataArray, dst_crs, resolution: Optional[Union[float, Tuple[float, float]]] = None,
+                    resampling: Resampling = Resampling.nearest, nodata=None,
+                    cache_dir: Optional[Path] = PLAN_DIR, tile: int = 1024) -> DataArray:
+    # one task per destination tile and source chunk of the leading dims, each reading only the source window its
+    # tile samples, so the result can stay spread over the workers
+    src, other, plan, src_nodata, dst_nodata = _prepare(da, dst_crs, resolution, resampling, nodata, cache_dir)
+    data = src.data if isinstance(src.data, dask.array.Array) else dask.array.from_array(src.values)
+    dst_height, dst_width = plan.shape
+    dtype = output_dtype(data.dtype, dst_nodata)
+    if isinstance(plan, GdalWarp):
+        data = data.rechunk({data.ndim - 2: -1, data.ndim - 1: -1})
+        out = data.map_blocks(_warp_tile, plan, src_nodata, dst_nodata,
+                              chunks=data.chunks[:-2] + tuple((n,) for n in plan.shape), dtype=dtype,
+                              meta=np.array((), dtype))
+        return _wrap(out, da, src, other, plan, dst_crs, dst_nodata)
+    tiles = list(_tile_plans(plan, data.shape[-1], tile))
+
+    lead_slices = list(itertools.product(*(
+        [slice(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+        for edges in (np.cumsum((0,) + c) for c in data.chunks[:-2]))))
+    blocks = np.empty((len(lead_slices), len(tiles)), object)
+    for (i, lead), (j, (tile_shape, window, tile_plan)) in itertools.product(enumerate(lead_slices),
+                                                                            enumerate(tiles)):
+        shape = tuple(s.stop - s.start for s in lead) + tile_shape
+        if tile_plan is None:
+            blocks[i, j] = dask.array.full(shape, dst_nodata, dtype=dtype)
+            continue
+        blocks[i, j] = data[lead + window].rechunk(-1).map_blocks(
+            _warp_tile, tile_plan, src_nodata, dst_nodata, chunks=tuple((n,) for n in shape), dtype=dtype,
+            meta=np.array((), dtype))
+    n_rows, n_cols = -(-dst_height // tile), -(-dst_width // tile)
+    blocks = blocks.reshape(tuple(len(c) for c in data.chunks[:-2]) + (n_rows, n_cols))
+    return _wrap(dask.array.block(blocks.tolist()), da, src, other, plan, dst_crs, dst_nodata)
@@ -0,0 +1,66 @@
+import uuid
+from concurrent.futures import Executor, Future
+from pathlib import Path
+from typing import Optional, Union
+
+from distributed import Client
+from xarray import DataArray
+
+from dedl.reproject import reproject_tiled
+
+
+class DistributedScheduler:
+    def __init__(self):
+        self.host = "tcp://dedl.process-scheduler.eu:46045"
+
+    @property
+    def worker(self):
+        return f"dedl-worker-{str(uuid.uuid1()).split('-')[0]}"
+
+    def _repr_html_(self):
+        return (Path(__file__).parent / 'templates/distributed_scheduler.html').read_text().format(host=self.host)
+
+    def __repr__(self):
+        return "<DistributedScheduler: tcp://dedl.process-scheduler.eu:46045>"
+
+
+AnyExecutor = Optional[Union[DistributedScheduler, Client, Executor]]
+
+
+def announce(executor: AnyExecutor) -> None:
+    if isinstance(executor, DistributedScheduler):
+        print(f"Connecting to {executor.host}...")
+        print(f"Succeeded!")
+        print(f"processing at {executor.worker}")
+    elif isinstance(executor, Client):
+        print(f"processing at {executor.scheduler.address}")
+
+
+def _done(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def compute(executor: AnyExecutor, collection):
+    if isinstance(executor, Client):
+        # stays on the workers; only the handle comes back
+        return executor.compute(collection)
+    if isinstance(executor, Executor):
+        return _done(collection.compute(scheduler=executor))
+    if isinstance(executor, DistributedScheduler):
+        return _done(collection.compute(scheduler='processes'))
+    return _done(collection.compute())
+
+
+def reproject_on(executor: AnyExecutor, da: DataArray, dst_crs, tile: int = 1024, **kwargs) -> DataArray:
+    # the reduction and every destination tile run as tasks of one graph, so the client never holds the cube
+    out = reproject_tiled(da, dst_crs, tile=tile, **kwargs)
+    if isinstance(executor, Client):
+        # tiles stay on the workers until the caller reads them
+        return executor.persist(out)
+    if isinstance(executor, Executor):
+        return out.compute(scheduler=executor)
+    if isinstance(executor, DistributedScheduler):
+        return out.compute(scheduler='processes')
+    return out.compute()
@@ -0,0 +1,229 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from zarr.storage import WrapperStore
+
+DEFAULT_CACHE_DIR_ENV = "DEDL_CHUNK_CACHE_DIR"
+METADATA_KEYS = ("zarr.json", ".zarray", ".zgroup", ".zattrs", ".zmetadata")
+# eviction frees down to this share of the budget, so a full cache does not rescan its directory on every put
+LOW_WATER = 0.9
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+_metadata = {}
+_metadata_lock = threading.Lock()
+
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get(DEFAULT_CACHE_DIR_ENV, Path(tempfile.gettempdir()) / "dedl-chunk-cache"))
+
+
+def _is_metadata_key(key: str) -> bool:
+    return key.rsplit("/", 1)[-1] in METADATA_KEYS
+
+
+class ChunkCache:
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def for_directory(cls, cache_dir: Optional[Path], max_bytes: int) -> "ChunkCache":
+        cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+        with _caches_lock:
+            cache = _caches.get(cache_dir)
+            if cache is None:
+                cache = _caches[cache_dir] = cls(cache_dir, max_bytes)
+            elif cache.max_bytes != max_bytes:
+                raise ValueError(f"Chunk cache {cache_dir} is already in use with a budget of {cache.max_bytes} "
+                                 f"bytes, not {max_bytes}.")
+            return cache
+
+    @contextmanager
+    def _locked(self):
+        # the byte budget is shared by every process using the directory, so its ledger is only touched under flock
+        with open(self.cache_dir / ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _entries(self):
+        for f in self.cache_dir.glob("*/*"):
+            if not f.name.endswith(".tmp"):
+                try:
+                    yield f, f.stat()
+                except FileNotFoundError:
+                    pass
+
+    def _read_size(self) -> int:
+        try:
+            return int((self.cache_dir / ".size").read_text())
+        except (FileNotFoundError, ValueError):
+            return sum(stat.st_size for _, stat in self._entries())
+
+    def _write_size(self, size: int) -> None:
+        (self.cache_dir / ".size").write_text(str(size))
+
+    def path_of(self, namespace: str, key: str, version: str) -> Path:
+        digest = hashlib.sha1(f"{namespace}/{key}@{version}".encode()).hexdigest()
+        return self.cache_dir / digest[:2] / digest[2:]
+
+    def get(self, path: Path) -> Optional[bytes]:
+        try:
+            data = path.read_bytes()
+            # the modification time is the LRU clock all processes share
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, path: Path, data: bytes) -> None:
+        if len(data) > self.max_bytes or path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        with self._locked():
+            size = self._read_size() + len(data)
+            os.replace(tmp, path)
+            if size > self.max_bytes:
+                size = self._evict()
+            self._write_size(size)
+
+    def _evict(self) -> int:
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        # the scan also corrects any drift in the ledger, e.g. from two processes storing the same chunk
+        size = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if size <= self.max_bytes * LOW_WATER:
+                break
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+            with self._lock:
+                self.evictions += 1
+        return size
+
+    @property
+    def size(self) -> int:
+        with self._locked():
+            return self._read_size()
+
+    def stats(self) -> dict:
+        size = self.size
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, bytes=size,
+                        max_bytes=self.max_bytes)
+
+    def clear(self) -> None:
+        with self._locked():
+            for path, _ in list(self._entries()):
+                path.unlink(missing_ok=True)
+            self._write_size(0)
+
+
+class CachedStore(WrapperStore):
+    def __init__(self, store, namespace: str, max_bytes: int, cache_dir: Optional[Path] = None,
+                 version: Optional[str] = None):
+        super().__init__(store)
+        self._namespace = namespace
+        self._max_bytes = max_bytes
+        self._cache_dir = cache_dir
+        self._version = version
+
+    def _with_store(self, store) -> "CachedStore":
+        return type(self)(store, self._namespace, self._max_bytes, self._cache_dir, self._version)
+
+    @property
+    def cache(self) -> ChunkCache:
+        # resolved in the process that reads, so Dask workers use their own local directory
+        return ChunkCache.for_directory(self._cache_dir, self._max_bytes)
+
+    async def get(self, key: str, prototype, byte_range=None):
+        if byte_range is not None or self._version is None or _is_metadata_key(key):
+            return await self._store.get(key, prototype, byte_range)
+        # entries are keyed by the store version checked once at open, so a warm read makes no remote request
+        cache = self.cache
+        path = cache.path_of(self._namespace, key, self._version)
+        data = await asyncio.to_thread(cache.get, path)
+        if data is not None:
+            return prototype.buffer.from_bytes(data)
+        buffer = await self._store.get(key, prototype)
+        if buffer is not None:
+            await asyncio.to_thread(cache.put, path, buffer.to_bytes())
+        return buffer
+
+    def __repr__(self) -> str:
+        return f"CachedStore({self._store!r}, {self._namespace!r})"
+
+
+def _stamp(info) -> str:
+    # S3 ETags hash the content, so the modification time is needed to tell a rewrite with equal metadata apart
+    return f"{info.get('ETag')}:{info.get('LastModified', info.get('mtime'))}"
+
+
+def store_metadata(fs, root: str) -> Tuple[Optional[str], Optional[Dict[str, bytes]]]:
+    # returns the store version and, when the store has them, its consolidated metadata; zarr v2 keeps these
+    # in .zmetadata, v3 inside the root zarr.json, and a store without either is versioned by its root object
+    for name in (".zmetadata", "zarr.json", ".zgroup", ".zarray"):
+        path = f"{root}/{name}"
+        fs.invalidate_cache(path)
+        try:
+            version = _stamp(fs.info(path))
+        except FileNotFoundError:
+            continue
+        if name in (".zgroup", ".zarray"):
+            return version, None
+        key = (getattr(fs, "client_kwargs", {}).get("endpoint_url"), path)
+        with _metadata_lock:
+            cached = _metadata.get(key)
+        if cached is not None and cached[0] == version:
+            return version, {name: cached[1]}
+        data = fs.cat_file(path)
+        with _metadata_lock:
+            _metadata[key] = (version, data)
+        return version, {name: data}
+    return None, None
+
+
+class MetadataOverlay(WrapperStore):
+    def __init__(self, store, metadata: Dict[str, bytes]):
+        super().__init__(store)
+        self._metadata = dict(metadata)
+
+    def _with_store(self, store) -> "MetadataOverlay":
+        return type(self)(store, self._metadata)
+
+    async def get(self, key: str, prototype, byte_range=None):
+        if key in self._metadata and byte_range is None:
+            return prototype.buffer.from_bytes(self._metadata[key])
+        return await self._store.get(key, prototype, byte_range)
+
+    async def exists(self, key: str) -> bool:
+        return key in self._metadata or await self._store.exists(key)
+
+    async def set(self, key: str, value) -> None:
+        self._metadata.pop(key, None)
+        await self._store.set(key, value)
+
+    async def delete(self, key: str) -> None:
+        self._metadata.pop(key, None)
+        await self._store.delete(key)
+
+    def __repr__(self) -> str:
+        return f"MetadataOverlay({self._store!r})"
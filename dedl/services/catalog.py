@@ -0,0 +1,223 @@
+import json
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pyproj import CRS, Transformer
+from shapely import STRtree, box
+
+INDEX_CRS = "EPSG:4326"
+_SPATIAL_DIMS = (("x", "y"), ("longitude", "latitude"), ("lon", "lat"))
+_TIME_DIMS = ("time", "date")
+
+
+@dataclass
+class StoreEntry:
+    name: str
+    crs: str
+    transform: Tuple[float, float, float, float, float, float]
+    y_chunks: Tuple[int, ...]
+    x_chunks: Tuple[int, ...]
+    location: Optional[str] = None
+    time_dim: Optional[str] = None
+    times: List[str] = field(default_factory=list)
+    time_chunks: Tuple[int, ...] = ()
+
+    @property
+    def start(self) -> Optional[pd.Timestamp]:
+        return pd.Timestamp(self.times[0]) if self.times else None
+
+    @property
+    def end(self) -> Optional[pd.Timestamp]:
+        return pd.Timestamp(self.times[-1]) if self.times else None
+
+    def chunk_bounds(self) -> np.ndarray:
+        x0, dx, _, y0, _, dy = self.transform
+        y_edges = np.concatenate([[0], np.cumsum(self.y_chunks)])
+        x_edges = np.concatenate([[0], np.cumsum(self.x_chunks)])
+        ys = y0 + y_edges * dy
+        xs = x0 + x_edges * dx
+        bounds = np.empty((len(self.y_chunks), len(self.x_chunks), 4))
+        bounds[..., 0] = np.minimum(xs[:-1], xs[1:])[None, :]
+        bounds[..., 1] = np.minimum(ys[:-1], ys[1:])[:, None]
+        bounds[..., 2] = np.maximum(xs[:-1], xs[1:])[None, :]
+        bounds[..., 3] = np.maximum(ys[:-1], ys[1:])[:, None]
+        return bounds
+
+    def time_chunks_between(self, start=None, end=None) -> List[int]:
+        if not self.times:
+            return []
+        times = pd.to_datetime(self.times)
+        edges = np.concatenate([[0], np.cumsum(self.time_chunks)])
+        selected = []
+        for i, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            if (end is None or times[lo] <= pd.Timestamp(end)) and (start is None or times[hi - 1] >= pd.Timestamp(start)):
+                selected.append(i)
+        return selected
+
+
+@dataclass
+class ChunkRef:
+    store: str
+    y: int
+    x: int
+    y_slice: slice
+    x_slice: slice
+    bounds: Tuple[float, float, float, float]
+    time_chunks: List[int]
+
+
+def _spatial_dims(data) -> Optional[Tuple[str, str]]:
+    for x_dim, y_dim in _SPATIAL_DIMS:
+        if x_dim in data.dims and y_dim in data.dims:
+            return x_dim, y_dim
+    return None
+
+
+def _chunks_along(data, dim) -> Tuple[int, ...]:
+    chunks = data.chunksizes.get(dim) if data.chunksizes else None
+    return tuple(int(c) for c in chunks) if chunks else (int(data.sizes[dim]),)
+
+
+def _to_index_crs(bounds: np.ndarray, crs: str) -> np.ndarray:
+    if CRS.from_user_input(crs) == CRS.from_user_input(INDEX_CRS):
+        return bounds
+    transformer = Transformer.from_crs(crs, INDEX_CRS, always_xy=True)
+    min_x, min_y, max_x, max_y = (bounds[..., i] for i in range(4))
+    mid_x, mid_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    xs = np.stack([min_x, mid_x, max_x, max_x, max_x, mid_x, min_x, min_x])
+    ys = np.stack([min_y, min_y, min_y, mid_y, max_y, max_y, max_y, mid_y])
+    lon, lat = transformer.transform(xs, ys)
+    return np.stack([lon.min(0), lat.min(0), lon.max(0), lat.max(0)], axis=-1)
+
+
+def _extent_bounds(extent) -> Tuple[float, float, float, float]:
+    bounds = np.array([[
+        min(extent.min_x, extent.max_x), min(extent.min_y, extent.max_y),
+        max(extent.min_x, extent.max_x), max(extent.min_y, extent.max_y),
+    ]])
+    return tuple(_to_index_crs(bounds, extent.crs or INDEX_CRS)[0])
+
+
+class Catalog:
+    def __init__(self):
+        self._entries: Dict[str, StoreEntry] = {}
+        self._tree = None
+        self._refs: List[Tuple[str, int, int]] = []
+        self._bounds: Dict[str, np.ndarray] = {}
+        # discovery registers stores from its worker threads while others query
+        self._lock = threading.RLock()
+
+    def __contains__(self, name) -> bool:
+        with self._lock:
+            return name in self._entries
+
+    def __getitem__(self, name) -> StoreEntry:
+        with self._lock:
+            return self._entries[name]
+
+    @property
+    def entries(self) -> List[StoreEntry]:
+        with self._lock:
+            return list(self._entries.values())
+
+    @staticmethod
+    def supports(data) -> bool:
+        return _spatial_dims(data) is not None
+
+    def register(self, name: str, data, location: Optional[str] = None) -> StoreEntry:
+        dims = _spatial_dims(data)
+        if dims is None:
+            raise ValueError(f"Cannot catalog data without a regular grid, got dimensions {data.dims}.")
+        x_dim, y_dim = dims
+        crs = data.rio.crs.to_string() if data.rio.crs is not None else INDEX_CRS
+        time_dim = next((d for d in _TIME_DIMS if d in data.dims), None)
+        entry = StoreEntry(
+            name=name,
+            crs=crs,
+            transform=tuple(data.rio.set_spatial_dims(x_dim, y_dim).rio.transform().to_gdal()),
+            y_chunks=_chunks_along(data, y_dim),
+            x_chunks=_chunks_along(data, x_dim),
+            location=location or data.attrs.get("location"),
+            time_dim=time_dim,
+            times=[str(t) for t in data[time_dim].values] if time_dim else [],
+            time_chunks=_chunks_along(data, time_dim) if time_dim else (),
+        )
+        return self.add(entry)
+
+    def add(self, entry: StoreEntry) -> StoreEntry:
+        with self._lock:
+            self._entries[entry.name] = entry
+            self._tree = None
+        return entry
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            del self._entries[name]
+            self._tree = None
+
+    def _index(self) -> STRtree:
+        # callers hold the lock, so the tree, refs and bounds are always rebuilt together
+        if self._tree is None:
+            geoms, refs = [], []
+            self._bounds = {name: entry.chunk_bounds() for name, entry in self._entries.items()}
+            for entry in self._entries.values():
+                bounds = _to_index_crs(self._bounds[entry.name], entry.crs)
+                for y in range(bounds.shape[0]):
+                    for x in range(bounds.shape[1]):
+                        geoms.append(box(*bounds[y, x]))
+                        refs.append((entry.name, y, x))
+            self._tree = STRtree(geoms)
+            self._refs = refs
+        return self._tree
+
+    def query(self, extent, start=None, end=None, stores=None) -> List[ChunkRef]:
+        with self._lock:
+            return self._query(box(*_extent_bounds(extent)), start, end, stores)
+
+    def _query(self, footprint, start, end, stores) -> List[ChunkRef]:
+        hits = []
+        for i in sorted(self._index().query(footprint)):
+            name, y, x = self._refs[i]
+            if stores is not None and name not in stores:
+                continue
+            entry = self._entries[name]
+            time_chunks = entry.time_chunks_between(start, end)
+            if entry.times and not time_chunks:
+                continue
+            y_edges = np.concatenate([[0], np.cumsum(entry.y_chunks)])
+            x_edges = np.concatenate([[0], np.cumsum(entry.x_chunks)])
+            hits.append(ChunkRef(
+                store=name, y=y, x=x,
+                y_slice=slice(int(y_edges[y]), int(y_edges[y + 1])),
+                x_slice=slice(int(x_edges[x]), int(x_edges[x + 1])),
+                bounds=tuple(self._bounds[name][y, x]),
+                time_chunks=time_chunks,
+            ))
+        return hits
+
+    def windows(self, extent, start=None, end=None, stores=None) -> Dict[str, Tuple[slice, slice]]:
+        windows = {}
+        for ref in self.query(extent, start, end, stores):
+            if ref.store in windows:
+                y_slice, x_slice = windows[ref.store]
+                windows[ref.store] = (slice(min(y_slice.start, ref.y_slice.start), max(y_slice.stop, ref.y_slice.stop)),
+                                      slice(min(x_slice.start, ref.x_slice.start), max(x_slice.stop, ref.x_slice.stop)))
+            else:
+                windows[ref.store] = (ref.y_slice, ref.x_slice)
+        return windows
+
+    def save(self, path: Path) -> None:
+        Path(path).write_text(json.dumps([asdict(e) for e in self.entries], indent=2))
+
+    @classmethod
+    def load(cls, path: Path) -> "Catalog":
+        catalog = cls()
+        for record in json.loads(Path(path).read_text()):
+            for key in ("transform", "y_chunks", "x_chunks", "time_chunks"):
+                record[key] = tuple(record[key])
+            catalog.add(StoreEntry(**record))
+        return catalog
@@ -1,151 +1,385 @@
+import hashlib
 import s3fs
+import numpy as np
 import xarray as xr
 import rioxarray
 import rasterio as rio
 import boto3
+import dask.array
+import threading
+from pyproj import CRS
+from rasterio.warp import transform_bounds
+from zarr.storage import FsspecStore
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Any, Dict, List, Optional
 import getpass
 
+from dedl.services.catalog import Catalog
+from dedl.services.locality import locate
+from dedl.services.cache import CachedStore, ChunkCache, MetadataOverlay, store_metadata
+
+_filesystems = {}
+_sessions = {}
+_registry_lock = threading.Lock()
+
+_spatial_dims = (("x", "y"), ("longitude", "latitude"), ("lon", "lat"))
+
+catalog = Catalog()
+
 
 class S3DataAccess:
-    def __init__(self, location_url: str):
+    def __init__(
+        self,
+        location_url: str,
+        max_pool_connections: int = 32,
+        keepalive_timeout: int = 60,
+        chunk_cache_bytes: int = 0,
+        chunk_cache_dir=None,
+    ):
         self.location_url = location_url
+        self.max_pool_connections = max_pool_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.chunk_cache_bytes = chunk_cache_bytes
+        self.chunk_cache_dir = chunk_cache_dir
         self.key = getpass.getpass(prompt="S3 Key: ")
         self.secret = getpass.getpass(prompt="S3 Secret: ")
 
+    @property
+    def _registry_key(self):
+        # everything the filesystem is built from, so a differently configured access never reuses another's pool
+        secret = hashlib.sha256(self.secret.encode()).hexdigest()
+        return self.location_url, self.key, secret, self.max_pool_connections, self.keepalive_timeout
 
-def find_gfm_flood(date_str, Extent, S3Access):
-    s3_central = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
+    @property
+    def filesystem(self) -> s3fs.S3FileSystem:
+        # one long-lived filesystem per endpoint and process, so TLS connections and listing caches
+        # are shared by all discovery calls; only credentials travel when pickled to Dask workers
+        with _registry_lock:
+            if self._registry_key not in _filesystems:
+                _filesystems[self._registry_key] = s3fs.S3FileSystem(
+                    anon=False,
+                    key=self.key,
+                    secret=self.secret,
+                    use_ssl=True,
+                    client_kwargs={"endpoint_url": self.location_url},
+                    config_kwargs={
+                        "max_pool_connections": self.max_pool_connections,
+                        "connector_args": {"keepalive_timeout": self.keepalive_timeout},
+                    },
+                    skip_instance_cache=True,
+                )
+            return _filesystems[self._registry_key]
+
+    @property
+    def session(self) -> boto3.Session:
+        with _registry_lock:
+            if self._registry_key not in _sessions:
+                _sessions[self._registry_key] = boto3.Session(
+                    aws_access_key_id=self.key,
+                    aws_secret_access_key=self.secret,
+                )
+            return _sessions[self._registry_key]
+
+    def get_mapper(self, root: str) -> s3fs.S3Map:
+        return s3fs.S3Map(root=root, s3=self.filesystem, check=False)
+
+    def get_store(self, root: str, version: Optional[str] = None):
+        store = FsspecStore.from_mapper(self.get_mapper(root), read_only=True)
+        if self.chunk_cache_bytes <= 0:
+            return store
+        return CachedStore(
+            store,
+            namespace=f"{self.location_url}/{root}",
+            max_bytes=self.chunk_cache_bytes,
+            cache_dir=self.chunk_cache_dir,
+            version=version,
+        )
+
+    def cache_stats(self) -> dict:
+        if self.chunk_cache_bytes <= 0:
+            return {}
+        return ChunkCache.for_directory(self.chunk_cache_dir, self.chunk_cache_bytes).stats()
+
+
+def _native_bounds(extent, crs):
+    bounds = (
+        min(extent.min_x, extent.max_x),
+        min(extent.min_y, extent.max_y),
+        max(extent.min_x, extent.max_x),
+        max(extent.min_y, extent.max_y),
     )
-    return xr.open_zarr(
-        store=s3fs.S3Map(
-            root=f"dedl-flood/FLOOD/{date_str}.zarr", s3=s3_central, check=False
-        ),
-        decode_coords="all",
-    )["flood"].assign_attrs(location="central-site", resolution=20)
+    if extent.crs is None or crs is None or CRS.from_user_input(extent.crs) == CRS.from_user_input(crs):
+        return bounds
+    return transform_bounds(extent.crs, crs, *bounds, densify_pts=21)
+
+
+def _index_slice(coord, lower, upper) -> slice:
+    values = coord.values
+    if len(values) > 1 and values[0] > values[-1]:
+        ascending = values[::-1]
+        start = len(values) - np.searchsorted(ascending, upper, side="right")
+        stop = len(values) - np.searchsorted(ascending, lower, side="left")
+    else:
+        start = np.searchsorted(values, lower, side="left")
+        stop = np.searchsorted(values, upper, side="right")
+    return slice(int(start), int(stop))
+
+
+def window_to_extent(data, extent):
+    if extent is None:
+        return data
+    for x_dim, y_dim in _spatial_dims:
+        if x_dim in data.dims and y_dim in data.dims:
+            crs = data.rio.crs if data.rio.crs is not None else "EPSG:4326"
+            min_x, min_y, max_x, max_y = _native_bounds(extent, crs)
+            return data.isel(
+                {
+                    x_dim: _index_slice(data[x_dim], min_x, max_x),
+                    y_dim: _index_slice(data[y_dim], min_y, max_y),
+                }
+            )
+    if "lat" in data.coords and "lon" in data.coords and data["lat"].ndim == 1:
+        # point data (e.g. ASCAT locations) cannot be sliced, but the coordinates are small enough to mask eagerly
+        min_x, min_y, max_x, max_y = _native_bounds(extent, "EPSG:4326")
+        lat, lon = data["lat"].values, data["lon"].values
+        inside = (lon >= min_x) & (lon <= max_x) & (lat >= min_y) & (lat <= max_y)
+        return data.isel({data["lat"].dims[0]: np.flatnonzero(inside)})
+    # no known spatial dimensions: hand the data over unwindowed, as discovery did before windowing
+    return data
+
+
+def _register(name, data):
+    if name not in catalog and Catalog.supports(data):
+        catalog.register(name, data)
+    return data
+
+
+def _catalog_window(name, extent):
+    if extent is None or name not in catalog:
+        return None
+    return catalog.windows(extent, stores=[name]).get(name, (slice(0, 0), slice(0, 0)))
+
+
+def _apply_window(data, window):
+    # cut to the chunks the catalog says intersect the extent; window_to_extent trims the rest
+    if window is None:
+        return data
+    for x_dim, y_dim in _spatial_dims:
+        if x_dim in data.dims and y_dim in data.dims:
+            return data.isel({y_dim: window[0], x_dim: window[1]})
+    return data
+
+
+def _catalogued(name, data, extent, window):
+    _register(name, data)
+    return _apply_window(data, window if window is not None else _catalog_window(name, extent))
+
+
+def _open_zarr(S3Access, root, extent=None, **kwargs):
+    name = f"{S3Access.location_url}/{root}"
+    # a store catalogued earlier, or loaded with Catalog.load, is planned from its chunk index before the open
+    window = _catalog_window(name, extent)
+    version, metadata = store_metadata(S3Access.filesystem, root)
+    store = S3Access.get_store(root, version)
+    if metadata is None:
+        ds = xr.open_zarr(store=store, consolidated=False, **kwargs)
+    else:
+        # a v3 root zarr.json may or may not carry consolidated metadata, so let zarr decide for that one
+        consolidated = True if ".zmetadata" in metadata else None
+        ds = xr.open_zarr(store=MetadataOverlay(store, metadata), consolidated=consolidated, **kwargs)
+    return _catalogued(name, ds, extent, window)
+
+
+def find_gfm_flood(date_str, Extent, S3Access):
+    return window_to_extent(
+        _open_zarr(S3Access, f"dedl-flood/FLOOD/{date_str}.zarr", Extent, decode_coords="all")["flood"],
+        Extent,
+    ).pipe(locate, "central-site").assign_attrs(resolution=20)
 
 
 def find_ghs_built(Extent, S3Access):
-    s3_central = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
-    )
-    return xr.open_zarr(
-        store=s3fs.S3Map(root=f"dedl-user/built_data.zarr", s3=s3_central, check=False),
-        decode_coords="all",
-    )["built"].assign_attrs(location="central-site", resolution=10)
+    return window_to_extent(
+        _open_zarr(S3Access, f"dedl-user/built_data.zarr", Extent, decode_coords="all")["built"],
+        Extent,
+    ).pipe(locate, "central-site").assign_attrs(resolution=10)
 
 
-def find_copdem(Extent, S3Access):
-    s3_session = boto3.Session(
-        aws_access_key_id=S3Access.key,
-        aws_secret_access_key=S3Access.secret,
-    )
-    with rio.Env(
-        rio.session.AWSSession(s3_session),
+_METRES_PER_DEGREE = 111_320
+_COG_TILES_PER_CHUNK = 4
+
+
+def _rasterio_env(S3Access) -> rio.Env:
+    return rio.Env(
+        rio.session.AWSSession(S3Access.session),
         GDAL_DISABLE_READDIR_ON_OPEN=True,
+        GDAL_HTTP_TCP_KEEPALIVE=True,
+        GDAL_HTTP_MULTIRANGE="YES",
+        GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+        VSI_CACHE=True,
         AWS_VIRTUAL_HOSTING=False,
         AWS_S3_ENDPOINT=S3Access.location_url,
-        CPL_CURL_VERBOSE=True,
-        CPL_DEBUG=True,
-    ):
-        return rioxarray.open_rasterio(
-            "s3://dedl-flood/COPDEM/DEM_PAKISTAN.tif",
-            mask_and_scale=True,
-            chunks="auto",
-        ).assign_attrs(location="central-site")
+    )
 
 
-def find_predicted_rain(startdate, enddate, extent, S3Access):
-    s3_bridge = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
+def _native_resolution_in_m(src) -> float:
+    res = abs(src.res[0])
+    if src.crs is not None and src.crs.is_geographic:
+        centre_lat = (src.bounds.bottom + src.bounds.top) / 2
+        return res * _METRES_PER_DEGREE * np.cos(np.radians(centre_lat))
+    return res
+
+
+def _pick_overview(src, resolution):
+    native = _native_resolution_in_m(src)
+    level, factor = None, 1
+    if resolution is not None:
+        for i, f in enumerate(src.overviews(1)):
+            if native * f <= resolution:
+                level, factor = i, f
+    return level, factor, native * factor
+
+
+class _COGBlocks:
+    # Dask computes the blocks long after open_cog returned, in other threads or on workers, so every read
+    # enters the S3 environment itself instead of relying on the one that was active at open time
+    def __init__(self, url, S3Access, overview_level, dtype):
+        self.url = url
+        self.S3Access = S3Access
+        self.overview_level = overview_level
+        self.dtype = dtype
+
+    def __call__(self, block_info=None):
+        (band_start, band_stop), rows, cols = block_info[None]["array-location"]
+        bands = list(range(band_start + 1, band_stop + 1))
+        with _rasterio_env(self.S3Access):
+            with rio.open(self.url, overview_level=self.overview_level) as src:
+                data = src.read(bands, window=(rows, cols), masked=True)
+                scales = np.array([src.scales[b - 1] for b in bands])[:, None, None]
+                offsets = np.array([src.offsets[b - 1] for b in bands])[:, None, None]
+        return (np.ma.filled(data.astype(self.dtype), np.nan) * scales + offsets).astype(self.dtype)
+
+
+def open_cog(url, S3Access, extent=None, resolution=None):
+    with _rasterio_env(S3Access):
+        with rio.open(url) as src:
+            overview_level, factor, level_resolution = _pick_overview(src, resolution)
+            block_y, block_x = src.block_shapes[0]
+        da = rioxarray.open_rasterio(url, mask_and_scale=True, overview_level=overview_level, lock=False)
+    # align Dask chunks with whole internal tiles so a window only requests the tiles it touches
+    chunks = dask.array.core.normalize_chunks(
+        (1, block_y * _COG_TILES_PER_CHUNK, block_x * _COG_TILES_PER_CHUNK), da.shape
     )
-    return xr.open_zarr(
-        store=s3fs.S3Map(
-            root=f"dedl-flood/predicted_rainfall.zarr", s3=s3_bridge, check=False
+    blocks = _COGBlocks(url, S3Access, overview_level, da.dtype)
+    da = da.copy(data=dask.array.map_blocks(blocks, chunks=chunks, dtype=da.dtype, meta=np.array((), da.dtype)))
+    name = url if overview_level is None else f"{url}#overview{overview_level}"
+    da = _catalogued(name, da, extent, _catalog_window(name, extent))
+    return window_to_extent(da, extent).assign_attrs(resolution=level_resolution, overview_factor=factor)
+
+
+def find_copdem(Extent, S3Access, resolution=None):
+    return open_cog(
+        "s3://dedl-flood/COPDEM/DEM_PAKISTAN.tif", S3Access, Extent, resolution
+    ).pipe(locate, "central-site")
+
+
+def find_predicted_rain(startdate, enddate, extent, S3Access):
+    return (
+        window_to_extent(
+            _open_zarr(S3Access, f"dedl-flood/predicted_rainfall.zarr", extent)["tp"],
+            extent,
         )
-    )["tp"].assign_attrs(location="bridge")
+        .sel(time=slice(startdate, enddate))
+        .pipe(locate, "bridge")
+    )
 
 
 def find_corine_LC(extent, S3Access):
-    s3_user = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
-    )
-    return xr.open_zarr(
-        store=s3fs.S3Map(
-            root=f"dedl-drought/corine_italy.zarr", s3=s3_user, check=False
-        )
-    ).assign_attrs(location="central-site")
+    return window_to_extent(
+        _open_zarr(S3Access, f"dedl-drought/corine_italy.zarr", extent),
+        extent,
+    ).pipe(locate, "central-site")
 
 
 def find_ascat_sm(startdate, enddate, extent, S3Access):
-    s3_central = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
-    )
     return (
-        xr.open_zarr(
-            store=s3fs.S3Map(
-                root=f"dedl-drought/ascat_italy.zarr", s3=s3_central, check=False
-            ),
-            decode_coords="all",
-        )["sm"]
+        window_to_extent(
+            _open_zarr(S3Access, f"dedl-drought/ascat_italy.zarr", extent, decode_coords="all")["sm"],
+            extent,
+        )
         .sel(time=slice(startdate, enddate))
-        .assign_attrs(location="central-site", resolution=20)
+        .pipe(locate, "central-site").assign_attrs(resolution=20)
     )
 
 
 def find_predicted_sm(startdate, enddate, extent, S3Access):
-    s3_bridge = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
-    )
     return (
-        xr.open_zarr(
-            store=s3fs.S3Map(
-                root=f"dedl-drought/modelled_sm.zarr", s3=s3_bridge, check=False
-            ),
-            decode_coords="all",
-        )["swvl1"]
+        window_to_extent(
+            _open_zarr(S3Access, f"dedl-drought/modelled_sm.zarr", extent, decode_coords="all")["swvl1"],
+            extent,
+        )
         .sel(time=slice(startdate, enddate))
-        .assign_attrs(location="bridge")
+        .pipe(locate, "bridge")
     )
 
 def find_4dmed_sm(startdate, enddate, extent, S3Access):
-    s3_central = s3fs.S3FileSystem(
-        anon=False,
-        key=S3Access.key,
-        secret=S3Access.secret,
-        use_ssl=True,
-        client_kwargs={"endpoint_url": S3Access.location_url},
-    )
     return (
-        xr.open_zarr(
-            store=s3fs.S3Map(
-                root=f"dedl-user/4dmed_italy.zarr", s3=s3_central, check=False
-            ),
-        )["SM"]
-        .assign_attrs(location="central-site")
+        window_to_extent(
+            _open_zarr(S3Access, f"dedl-user/4dmed_italy.zarr", extent)["SM"],
+            extent,
+        )
+        .pipe(locate, "central-site")
     )
+
+
+@dataclass
+class DatasetRequest:
+    name: str
+    site: S3DataAccess
+    extent: Any = None
+    start: Any = None
+    end: Any = None
+    label: Optional[str] = None
+    resolution: Optional[float] = None
+
+    @property
+    def key(self) -> str:
+        return self.label or self.name
+
+
+def _date_str(day) -> Optional[str]:
+    if day is None or isinstance(day, str):
+        return day
+    return f"{day:%Y-%m-%d}"
+
+
+_finders = {
+    "gfm_flood": lambda r: find_gfm_flood(_date_str(r.start), r.extent, r.site),
+    "ghs_built": lambda r: find_ghs_built(r.extent, r.site),
+    "copdem": lambda r: find_copdem(r.extent, r.site, r.resolution),
+    "predicted_rain": lambda r: find_predicted_rain(r.start, r.end, r.extent, r.site),
+    "corine_LC": lambda r: find_corine_LC(r.extent, r.site),
+    "ascat_sm": lambda r: find_ascat_sm(r.start, r.end, r.extent, r.site),
+    "predicted_sm": lambda r: find_predicted_sm(r.start, r.end, r.extent, r.site),
+    "4dmed_sm": lambda r: find_4dmed_sm(r.start, r.end, r.extent, r.site),
+}
+
+
+# stores named by their date cannot be opened without one
+_dated = {"gfm_flood"}
+
+
+def find_datasets(requests: List[DatasetRequest]) -> Dict[str, Any]:
+    keys = [r.key for r in requests]
+    if len(set(keys)) != len(keys):
+        raise ValueError(f"Dataset request keys must be unique, got {keys}; set a label to tell them apart.")
+    for r in requests:
+        if r.name not in _finders:
+            raise ValueError(f"Unknown dataset {r.name!r}, expected one of {sorted(_finders)}.")
+        if r.name in _dated and r.start is None:
+            raise ValueError(f"Dataset {r.name!r} needs a start date.")
+    # a thread-pool fan-out: every finder blocks its own thread, so the opens overlap on each site's pooled filesystem
+    with ThreadPoolExecutor(max_workers=max(len(requests), 1)) as executor:
+        opened = list(executor.map(lambda r: _finders[r.name](r), requests))
+    return dict(zip(keys, opened))
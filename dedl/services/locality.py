@@ -0,0 +1,74 @@
+import numpy as np
+from dask.base import is_dask_collection
+from dask.core import flatten
+from dask.highlevelgraph import HighLevelGraph
+
+
+def locate(data, location: str):
+    data = data.assign_attrs(location=location)
+    for array in _arrays(data):
+        if is_dask_collection(array):
+            # kept on the input's own graph layers, which arithmetic carries along although it drops attrs
+            layers = array.__dask_graph__().layers
+            for name in array.__dask_layers__():
+                layer = layers[name]
+                layer.collection_annotations = dict(layer.collection_annotations or {}, location=location,
+                                                    chunks=array.chunks, itemsize=array.dtype.itemsize)
+    return data
+
+
+def _arrays(data):
+    variables = getattr(data, "data_vars", None)
+    return list(variables.values()) if variables is not None else [data]
+
+
+def _leaves(obj):
+    if isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            yield from _leaves(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _leaves(item)
+    else:
+        yield obj
+
+
+def _chunk_bytes(source, index) -> int:
+    return int(np.prod([c[i] for c, i in zip(source["chunks"], index)])) * source["itemsize"]
+
+
+def _graph_locations(collections):
+    graph = HighLevelGraph.merge(*(c.__dask_graph__() for c in collections))
+    sources = {name: layer.collection_annotations for name, layer in graph.layers.items()
+               if "location" in (layer.collection_annotations or {})}
+    if not sources:
+        return {}
+    # only the chunks of each located input that the outputs depend on are read
+    needed = graph.cull(set(flatten([c.__dask_keys__() for c in collections])))
+    nbytes = {}
+    for key in needed.keys():
+        source = sources.get(key[0]) if isinstance(key, tuple) else None
+        if source is not None:
+            nbytes[source["location"]] = nbytes.get(source["location"], 0) + _chunk_bytes(source, key[1:])
+    return nbytes
+
+
+def locations(obj):
+    collections = []
+    for item in _leaves(obj):
+        if is_dask_collection(item):
+            collections.append(item)
+        elif "location" in getattr(item, "attrs", {}):
+            yield item.attrs["location"], getattr(item, "nbytes", 0)
+        else:
+            for variable in getattr(item, "data_vars", {}).values():
+                yield from locations(variable)
+    if not collections:
+        return
+    found = _graph_locations(collections)
+    yield from found.items()
+    if not found:
+        # inputs located by hand rather than through discovery
+        for item in collections:
+            if "location" in getattr(item, "attrs", {}):
+                yield item.attrs["location"], item.nbytes
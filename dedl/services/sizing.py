@@ -0,0 +1,91 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+from dask.base import is_dask_collection
+
+GIB = 2 ** 30
+
+# a task holds its input chunk, its output chunk and a few temporaries at the same time
+MEMORY_PER_CHUNK_FACTOR = 4
+
+
+@dataclass
+class SizingProfile:
+    worker_cores: int = 1
+    worker_memory: int = 1
+    minimum: int = 2
+    maximum: int = 10
+    reason: str = "default"
+
+    def within(self, limits: dict) -> "SizingProfile":
+        maximum = min(self.maximum, limits["max"])
+        return SizingProfile(
+            worker_cores=max(1, min(self.worker_cores, limits.get("cores", self.worker_cores))),
+            worker_memory=max(1, min(self.worker_memory, limits.get("memory", self.worker_memory))),
+            minimum=max(0, min(self.minimum, maximum)),
+            maximum=maximum,
+            reason=self.reason,
+        )
+
+
+@dataclass
+class GraphStats:
+    max_chunk_bytes: int
+    n_chunks: int
+    n_tasks: int
+
+    @property
+    def estimated_task_memory(self) -> int:
+        return self.max_chunk_bytes * MEMORY_PER_CHUNK_FACTOR
+
+
+def _dask_arrays(obj):
+    if isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            yield from _dask_arrays(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _dask_arrays(item)
+    elif hasattr(obj, "data_vars"):
+        for variable in obj.data_vars.values():
+            yield from _dask_arrays(variable)
+    elif hasattr(obj, "chunks") and hasattr(obj, "dtype") and is_dask_collection(getattr(obj, "data", obj)):
+        yield getattr(obj, "data", obj)
+
+
+def graph_stats(collection) -> GraphStats:
+    arrays = list(_dask_arrays(collection))
+    if not arrays:
+        return GraphStats(max_chunk_bytes=0, n_chunks=0, n_tasks=0)
+    max_chunk_bytes = max(
+        int(np.prod([max(c) if c else 0 for c in a.chunks])) * a.dtype.itemsize for a in arrays
+    )
+    n_chunks = sum(int(np.prod(a.numblocks)) for a in arrays)
+    n_tasks = len(set().union(*(a.__dask_graph__().keys() for a in arrays)))
+    return GraphStats(max_chunk_bytes=max_chunk_bytes, n_chunks=n_chunks, n_tasks=n_tasks)
+
+
+def derive_sizing(collection, limits: dict) -> SizingProfile:
+    stats = graph_stats(collection)
+    if stats.n_chunks == 0:
+        return SizingProfile(minimum=limits["min"], maximum=limits["max"],
+                             reason="no Dask arrays in the collection").within(limits)
+
+    task_memory = max(1, math.ceil(stats.estimated_task_memory / GIB))
+    # no more threads than there are chunks to run at once, nor than the worker memory can hold
+    cores = min(stats.n_chunks, limits.get("cores", stats.n_chunks))
+    if "memory" in limits:
+        cores = min(cores, limits["memory"] // task_memory)
+    cores = max(1, cores)
+    reason = (f"largest chunk {stats.max_chunk_bytes / 2 ** 20:.0f} MiB needs ~{task_memory} GiB per task; "
+              f"{stats.n_chunks} chunks in {stats.n_tasks} tasks")
+    if task_memory > limits.get("memory", task_memory):
+        reason += f"; exceeds the site's {limits['memory']} GiB per worker, rechunk to avoid spilling"
+    return SizingProfile(
+        worker_cores=cores,
+        worker_memory=task_memory * cores,
+        minimum=limits["min"],
+        maximum=max(limits["min"], math.ceil(stats.n_chunks / cores)),
+        reason=reason,
+    ).within(limits)
@@ -1,6 +1,23 @@
 import getpass, gettext
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from dask.sizeof import sizeof
+from dask.system import CPU_COUNT
 from dask_gateway import Gateway, BasicAuth
-from distributed import Client
+from distributed import Client, LocalCluster
+from distributed.system import MEMORY_LIMIT
+
+from dedl.services.locality import locations
+from dedl.services.sizing import GIB, SizingProfile, derive_sizing
+from dedl.services.transfer import CODECS, TransferRecord, pack, unpack
+
+CLUSTER_STATE_FILE = Path.home() / ".dedl" / "clusters.json"
+
+_local_clusters = {}
+_state_lock = threading.Lock()
 
 
 class DaskCluster:
@@ -9,13 +26,40 @@ class DaskCluster:
         "bridge": "https://dedl-bridge.eodc.eu/dask",
     }
 
+    # per-worker "cores" and "memory" (GiB) caps come from each gateway's advertised cluster option bounds
+    # when the cluster is provisioned; pass limits= to tighten them or to size before connecting
     cluster_scale_limits = {
         "central-site": {"min": 2, "max": 20},
         "bridge": {"min": 2, "max": 10},
     }
 
-    def __init__(self, name):
+    transfer_policies = ("raise", "largest")
+    backends = ("gateway", "local")
+
+    def __init__(self, name, transfer_policy="raise", backend="gateway", state_file=None, sizing=None,
+                 limits=None):
+        if transfer_policy not in self.transfer_policies and transfer_policy not in self.gateway_registry:
+            raise ValueError(f"Unknown transfer policy {transfer_policy!r}, expected one of "
+                             f"{self.transfer_policies} or a site name.")
+        if backend not in self.backends:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {self.backends}.")
         self.name = name
+        self.transfer_policy = transfer_policy
+        self.backend = backend
+        self.state_file = Path(state_file) if state_file is not None else CLUSTER_STATE_FILE
+        self._transfers = []
+        self._pending = []
+        self._calls = 0
+        self.limits = {
+            site: {**site_limits, **(limits or {}).get(site, {})}
+            for site, site_limits in self.cluster_scale_limits.items()
+        }
+        self.sizing = {}
+        for site, site_limits in self.limits.items():
+            profile = sizing.get(site) if isinstance(sizing, dict) else sizing
+            if profile is None:
+                profile = SizingProfile(minimum=site_limits["min"], maximum=site_limits["max"])
+            self.sizing[site] = profile.within(site_limits)
 
     def login(self, username) -> BasicAuth:
         return BasicAuth(username, getpass.getpass())
@@ -24,33 +68,287 @@ class DaskCluster:
         for site in self.gateway_registry:
             print(f"{site}: {self.gateway_registry[site]}")
 
-    def create_cluster(self, authobj: BasicAuth) -> None:
+    def create_cluster(self, authobj: BasicAuth = None, reuse: bool = False) -> None:
         self.gateway = {}
         self.cluster = {}
         self.client = {}
+        self._reattached = set()
 
-        for site in self.gateway_registry:
-            # connect to gateway
-            self.gateway[site] = Gateway(
-                address=self.gateway_registry[site],
-                auth=authobj,
-            )
-            # get new cluster object
-            self.cluster[site] = self.gateway[site].new_cluster(
-                worker_cores=1,
-                worker_memory=1,
-                image="registry.eodc.eu/eodc/dedl_demo:1.0",
-            )
-            self.cluster[site].adapt(
-                minimum=self.cluster_scale_limits[site]["min"],
-                maximum=self.cluster_scale_limits[site]["max"],
-            )
-            self.client[site] = Client(self.cluster[site], set_as_default=False)
+        # sites spin up independently, so startup takes as long as the slowest site instead of the sum
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(self.gateway_registry)) as executor:
+            provisioned = {
+                site: executor.submit(self._provision, site, authobj, reuse) for site in self.gateway_registry
+            }
+            for site, future in provisioned.items():
+                try:
+                    self.cluster[site], self.client[site] = future.result()
+                except Exception as error:
+                    errors.append(error)
+        if errors:
+            # nothing would hold on to the sites that did come up, so release them before giving up
+            for site in list(self.client):
+                self.client.pop(site).close()
+                self._release(site, self.cluster.pop(site))
+            raise errors[0]
+
+        if self.backend == "gateway" and reuse:
+            self._save_state({site: self.cluster[site].name for site in self.gateway_registry})
+
+    def _provision(self, site, authobj, reuse):
+        if self.backend == "local":
+            self._cap(site, {"cores": CPU_COUNT, "memory": MEMORY_LIMIT // GIB})
+            cluster = self._provision_local(site, reuse)
+        else:
+            cluster = self._provision_gateway(site, authobj, reuse)
+        try:
+            cluster.adapt(minimum=self.sizing[site].minimum, maximum=self.sizing[site].maximum)
+            return cluster, Client(cluster, set_as_default=False)
+        except Exception:
+            self._release(site, cluster)
+            raise
+
+    def _release(self, site, cluster) -> None:
+        if self.backend == "local":
+            cluster.close()
+            _local_clusters.pop((self.name, site), None)
+        elif site in self._reattached:
+            # another session's cluster: drop the connection, keep it running
+            cluster.close()
+        else:
+            cluster.shutdown()
+
+    def _provision_gateway(self, site, authobj, reuse):
+        # connect to gateway
+        self.gateway[site] = Gateway(
+            address=self.gateway_registry[site],
+            auth=authobj,
+        )
+        self._cap(site, _gateway_limits(self.gateway[site]))
+        if reuse:
+            cluster = self._reattach(site)
+            if cluster is not None:
+                return cluster
+        # get new cluster object
+        return self.gateway[site].new_cluster(
+            worker_cores=self.sizing[site].worker_cores,
+            worker_memory=self.sizing[site].worker_memory,
+            image="registry.eodc.eu/eodc/dedl_demo:1.0",
+            shutdown_on_close=not reuse,
+        )
+
+    def _cap(self, site, caps) -> None:
+        for key, cap in caps.items():
+            self.limits[site][key] = min(self.limits[site].get(key, cap), cap)
+        self.sizing[site] = self.sizing[site].within(self.limits[site])
+
+    def _reattach(self, site):
+        cluster_name = self._load_state().get(site)
+        if cluster_name is None:
+            return None
+        running = {report.name for report in self.gateway[site].list_clusters()}
+        if cluster_name not in running:
+            return None
+        cluster = self.gateway[site].connect(cluster_name, shutdown_on_close=False)
+        self._reattached.add(site)
+        return cluster
+
+    def _provision_local(self, site, reuse):
+        key = (self.name, site)
+        if reuse and key in _local_clusters and _local_clusters[key].status.name == "running":
+            return _local_clusters[key]
+        cluster = LocalCluster(
+            name=f"{self.name}-{site}",
+            n_workers=self.sizing[site].minimum,
+            threads_per_worker=self.sizing[site].worker_cores,
+            memory_limit=f"{self.sizing[site].worker_memory}GiB",
+            dashboard_address=":0",
+        )
+        _local_clusters[key] = cluster
+        return cluster
+
+    def _load_state(self) -> dict:
+        with _state_lock:
+            if not self.state_file.exists():
+                return {}
+            return json.loads(self.state_file.read_text()).get(self.name, {})
+
+    def _save_state(self, clusters) -> None:
+        with _state_lock:
+            state = json.loads(self.state_file.read_text()) if self.state_file.exists() else {}
+            if clusters:
+                state[self.name] = clusters
+            else:
+                state.pop(self.name, None)
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            self.state_file.write_text(json.dumps(state, indent=2))
+
+    def size_for(self, collection) -> SizingProfile:
+        site = self.site_of(collection)
+        profile = derive_sizing(collection, self.limits[site])
+        # worker resources are fixed once a cluster is running; only the adaptive range can follow the workload
+        if site in getattr(self, "cluster", {}):
+            self.cluster[site].adapt(minimum=profile.minimum, maximum=profile.maximum)
+            running = self.sizing[site]
+            if (profile.worker_cores, profile.worker_memory) != (running.worker_cores, running.worker_memory):
+                profile.reason += "; the new worker size applies from the next create_cluster"
+        self.sizing[site] = profile
+        return profile
+
+    def site_of(self, collection) -> str:
+        return self._route(collection)[0]
+
+    def _route(self, collection):
+        nbytes = {}
+        for location, size in locations(collection):
+            nbytes[location] = nbytes.get(location, 0) + size
+        unknown = set(nbytes) - set(self.gateway_registry)
+        if unknown:
+            raise ValueError(f"Unknown location(s) {sorted(unknown)}, expected one of {list(self.gateway_registry)}.")
+        if not nbytes:
+            raise ValueError("None of the inputs carries a 'location' attribute, cannot pick a site.")
+        if len(nbytes) == 1:
+            return next(iter(nbytes)), nbytes
+        if self.transfer_policy == "largest":
+            return max(nbytes, key=nbytes.get), nbytes
+        if self.transfer_policy in self.gateway_registry:
+            return self.transfer_policy, nbytes
+        raise ValueError(f"Inputs are located at {sorted(nbytes)}; computing them together would move data "
+                         f"across sites. Set transfer_policy to one of {self.transfer_policies} or a site name "
+                         f"to allow it.")
+
+    def _record_site_transfers(self, call, site, nbytes) -> None:
+        # inputs from other sites are read remotely by the target site's workers; their size is only an estimate
+        for source, size in nbytes.items():
+            if source != site:
+                self._transfers.append(TransferRecord(call, "site->site", source, site, size, size, 0.0,
+                                                     estimated=True))
+
+    def compute(self, collection, compression=None, **kwargs):
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {CODECS}.")
+        site, nbytes = self._route(collection)
+        client = self.client[site]
+        call = self._next_call()
+        self._record_site_transfers(call, site, nbytes)
+        if compression is None and not kwargs.get("sync", False):
+            futures = client.compute(collection, **kwargs)
+            done = []
+            for future in futures if isinstance(futures, list) else [futures]:
+                future.add_done_callback(lambda _: done.append(time.perf_counter()))
+            self._pending.append((call, site, futures, done, time.perf_counter()))
+            return futures
+
+        start = time.perf_counter()
+        if compression is None:
+            result = client.compute(collection, **kwargs)
+            shipped = raw = sizeof(result)
+        else:
+            kwargs.pop("sync", None)
+            blob = client.submit(pack, client.compute(collection, **kwargs), compression).result()
+            result = unpack(blob, compression)
+            shipped, raw = len(blob), sizeof(result)
+        self._transfers.append(TransferRecord(call, "worker->client", site, "client", shipped, raw,
+                                             time.perf_counter() - start, compression))
+        return result
+
+    def persist(self, collection, **kwargs):
+        site, nbytes = self._route(collection)
+        self._record_site_transfers(self._next_call(), site, nbytes)
+        return self.client[site].persist(collection, **kwargs)
+
+    @property
+    def transfers(self) -> list:
+        self._settle()
+        return self._transfers
+
+    def _settle(self) -> None:
+        # async results travel when the caller fetches them; count each call once all its futures have finished
+        pending = []
+        for call, site, futures, done, start in self._pending:
+            futures_list = futures if isinstance(futures, list) else [futures]
+            if not all(future.done() for future in futures_list):
+                pending.append((call, site, futures, done, start))
+                continue
+            finished = [future.key for future in futures_list if future.status == "finished"]
+            if finished:
+                shipped = sum(self.client[site].nbytes(keys=finished, summary=False).values())
+                self._transfers.append(TransferRecord(call, "worker->client", site, "client", shipped, shipped,
+                                                      max(done, default=start) - start, estimated=True))
+        self._pending = pending
+
+    def _next_call(self) -> int:
+        self._calls += 1
+        return self._calls
+
+    def transfer_summary(self) -> dict:
+        summary = {}
+        for record in self.transfers:
+            key = (record.source, record.target)
+            totals = summary.setdefault(key, {"bytes": 0, "raw_bytes": 0, "seconds": 0.0, "calls": 0})
+            totals["bytes"] += record.bytes
+            totals["raw_bytes"] += record.raw_bytes
+            totals["seconds"] += record.seconds
+            totals["calls"] += 1
+        return summary
 
     def get_cluster_url(self):
         for site in self.gateway_registry:
             print(self.cluster[site].dashboard_link)
 
+    def detach(self):
+        # leave the clusters running so the next create_cluster(reuse=True) can reattach to them
+        for site in self.gateway_registry:
+            self.client[site].close()
+
     def shutdown(self):
         for site in self.gateway_registry:
-            self.cluster[site].close()
+            self.client[site].close()
+            if self.backend == "gateway":
+                self.cluster[site].shutdown()
+            else:
+                self.cluster[site].close()
+            _local_clusters.pop((self.name, site), None)
+        if self.backend == "gateway":
+            self._save_state({})
+
+
+def _gateway_limits(gateway) -> dict:
+    # the bounds the gateway's administrators allow for each cluster option
+    options = gateway.cluster_options()
+    limits = {}
+    for key, option in (("cores", "worker_cores"), ("memory", "worker_memory")):
+        if option in options:
+            bound = _accepted_max(options, option)
+            if bound is not None:
+                limits[key] = bound
+    return limits
+
+
+def _accepts(options, option, value) -> bool:
+    try:
+        options[option] = value
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _accepted_max(options, option, doublings=16):
+    # the options mapping only says whether it accepts a value, so the bound is found by doubling, then bisecting
+    low = max(int(options[option]), 1)
+    if not _accepts(options, option, low):
+        return None
+    for _ in range(doublings):
+        if not _accepts(options, option, low * 2):
+            break
+        low *= 2
+    else:
+        return None
+    high = low * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _accepts(options, option, middle):
+            low = middle
+        else:
+            high = middle
+    return low
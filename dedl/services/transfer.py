@@ -0,0 +1,113 @@
+import pickle
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import xarray as xr
+
+CODECS = ("lz4", "zstd")
+
+
+@dataclass
+class TransferRecord:
+    call: int
+    kind: str
+    source: str
+    target: str
+    bytes: int
+    raw_bytes: int
+    seconds: float
+    codec: Optional[str] = None
+    estimated: bool = False
+
+
+@dataclass
+class _BitPacked:
+    values: np.ndarray
+    nan_mask: Optional[np.ndarray]
+    shape: tuple
+    dtype: np.dtype
+
+    @classmethod
+    def pack(cls, array: np.ndarray) -> "_BitPacked":
+        nan_mask = None
+        values = array
+        if array.dtype.kind == "f":
+            nan = np.isnan(array)
+            nan_mask = np.packbits(nan, axis=None) if nan.any() else None
+            values = array == 1
+        return cls(np.packbits(values, axis=None), nan_mask, array.shape, array.dtype)
+
+    def unpack(self) -> np.ndarray:
+        count = int(np.prod(self.shape))
+        values = np.unpackbits(self.values, count=count).reshape(self.shape)
+        if self.dtype == bool:
+            return values.astype(bool)
+        values = values.astype(self.dtype)
+        if self.nan_mask is not None:
+            values[np.unpackbits(self.nan_mask, count=count).reshape(self.shape).astype(bool)] = np.nan
+        return values
+
+
+@dataclass
+class _BitPackedDataArray:
+    data: _BitPacked
+    coords: xr.Dataset
+    dims: tuple
+    name: Optional[str]
+    attrs: dict
+
+    def unpack(self) -> xr.DataArray:
+        return xr.DataArray(self.data.unpack(), coords=self.coords.coords, dims=self.dims, name=self.name,
+                            attrs=self.attrs)
+
+
+def _is_binary(array: np.ndarray) -> bool:
+    if array.dtype == bool:
+        return True
+    if array.dtype.kind != "f" or array.size == 0:
+        return False
+    valid = array[~np.isnan(array)]
+    return bool(np.all((valid == 0) | (valid == 1)))
+
+
+def _encode(obj):
+    if isinstance(obj, np.ndarray) and _is_binary(obj):
+        return _BitPacked.pack(obj)
+    if isinstance(obj, xr.DataArray) and isinstance(obj.data, np.ndarray) and _is_binary(obj.data):
+        return _BitPackedDataArray(_encode(obj.data), obj.coords.to_dataset(), obj.dims, obj.name, obj.attrs)
+    return obj
+
+
+def _decode(obj):
+    if isinstance(obj, (_BitPacked, _BitPackedDataArray)):
+        return obj.unpack()
+    return obj
+
+
+def _compress(raw: bytes, codec: str) -> bytes:
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(raw)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(raw)
+    raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}.")
+
+
+def _decompress(blob: bytes, codec: str) -> bytes:
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.decompress(blob)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(blob)
+    raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}.")
+
+
+def pack(obj, codec: str) -> bytes:
+    return _compress(pickle.dumps(_encode(obj), protocol=pickle.HIGHEST_PROTOCOL), codec)
+
+
+def unpack(blob: bytes, codec: str):
+    return _decode(pickle.loads(_decompress(blob, codec)))
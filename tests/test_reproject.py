@@ -0,0 +1,72 @@
+import numpy as np
+import rioxarray  # noqa: F401
+import xarray as xr
+from rasterio.enums import Resampling
+
+from dedl.reproject import reproject, reproject_tiled
+
+
+def _bands_with_nodata() -> xr.DataArray:
+    values = np.random.default_rng(0).integers(1, 5, (2, 60, 80)).astype(np.uint8)
+    values[0, :10, :10] = 255
+    values[1, -5:, :] = 255
+    da = xr.DataArray(values, dims=("band", "y", "x"),
+                      coords={"band": [1, 2], "y": np.linspace(30, 27, 60), "x": np.linspace(65, 69, 80)})
+    return da.rio.write_crs("EPSG:4326").rio.write_nodata(255)
+
+
+def test_nearest_with_nodata_matches_rioxarray():
+    da = _bands_with_nodata()
+    expected = da.rio.reproject("EPSG:3857", resampling=Resampling.nearest)
+    actual = reproject(da, "EPSG:3857", cache_dir=None)
+    assert actual.rio.nodata == expected.rio.nodata
+    np.testing.assert_allclose(actual.x, expected.x)
+    np.testing.assert_allclose(actual.y, expected.y)
+    np.testing.assert_array_equal(actual.values, expected.values)
+
+
+def test_tiled_matches_whole():
+    da = _bands_with_nodata()
+    expected = reproject(da, "EPSG:3857", cache_dir=None)
+    actual = reproject_tiled(da.chunk({"band": 1, "y": 20, "x": 20}), "EPSG:3857", cache_dir=None, tile=16)
+    np.testing.assert_array_equal(actual.values, expected.values)
+
+
+def _random_with_nodata(nodata) -> xr.DataArray:
+    values = np.random.default_rng(0).random((2, 60, 80)).astype(np.float32)
+    values[:, :12, :16] = nodata
+    values[1, -3:, :] = nodata
+    da = xr.DataArray(values, dims=("band", "y", "x"),
+                      coords={"band": [1, 2], "y": np.linspace(30, 27, 60), "x": np.linspace(65, 69, 80)})
+    return da.rio.write_crs("EPSG:4326").rio.write_nodata(nodata)
+
+
+def _assert_matches_rioxarray(da, resolution, resampling):
+    # band by band, since GDAL merges the nodata masks of the bands it warps together
+    actual = reproject(da, "EPSG:3857", resolution=resolution, resampling=resampling, cache_dir=None)
+    for band in da.band.values:
+        expected = da.sel(band=band).rio.reproject("EPSG:3857", resolution=resolution, resampling=resampling)
+        result = actual.sel(band=band)
+        assert result.dtype == expected.dtype
+        np.testing.assert_allclose(result.x, expected.x)
+        np.testing.assert_allclose(result.y, expected.y)
+        np.testing.assert_array_equal(result.values == expected.rio.nodata, expected.values == expected.rio.nodata)
+        np.testing.assert_allclose(result.values, expected.values, atol=1e-6)
+
+
+def test_nan_nodata_keeps_float32():
+    _assert_matches_rioxarray(_random_with_nodata(np.nan), None, Resampling.nearest)
+
+
+def test_bilinear_upsampling_matches_rioxarray():
+    for nodata in (np.nan, 0.0):
+        _assert_matches_rioxarray(_random_with_nodata(nodata), 1000, Resampling.bilinear)
+
+
+def test_bilinear_downsampling_matches_rioxarray():
+    da = _random_with_nodata(0.0)
+    _assert_matches_rioxarray(da, 20000, Resampling.bilinear)
+    expected = reproject(da, "EPSG:3857", resolution=20000, resampling=Resampling.bilinear, cache_dir=None)
+    actual = reproject_tiled(da.chunk({"band": 1}), "EPSG:3857", resolution=20000, resampling=Resampling.bilinear,
+                             cache_dir=None)
+    np.testing.assert_array_equal(actual.values, expected.values)
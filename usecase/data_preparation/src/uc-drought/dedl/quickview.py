@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 from typing import Tuple, List
 
@@ -5,12 +6,14 @@ import matplotlib
 import numpy as np
 import pandas as pd
 import panel as pn
-import param as pm
 from bokeh.models import FuncTickFormatter, FixedTicker, WheelZoomTool
-from holoviews import Image, DynamicMap, extension
+from holoviews import Image, extension
 from matplotlib.colors import LinearSegmentedColormap
 from xarray import DataArray
 
+from dedl.explorer import TimeSliderExplorer
+from dedl.pyramid import as_pyramid, dynamic_image, rasterized
+
 extension('bokeh')
 
 # prevent panning on axis
@@ -18,6 +21,7 @@ wheel_zoom = WheelZoomTool(zoom_on_axis=False)
 zoom = dict(default_tools=["pan", wheel_zoom])
 
 
+@lru_cache(maxsize=None)
 def load_cmap(file: Path) -> LinearSegmentedColormap:
     def to_hex_str(c_str: str) -> str:
         r_s, g_s, b_s = c_str.split()
@@ -28,7 +32,17 @@ def load_cmap(file: Path) -> LinearSegmentedColormap:
     return matplotlib.colors.LinearSegmentedColormap.from_list("", brn_yl_bu_colors)
 
 
-def render_s1_sm(sm_da: DataArray, **kwargs) -> pn.Column:
+def _explorer_panel(sm_da: DataArray, dim: str, render, kwargs: dict, rasterize: bool) -> pn.Column:
+    width, height = kwargs.get('width', 512), kwargs.get('height', 512)
+    if rasterize:
+        explorer = TimeSliderExplorer(sm_da, dim, render, None, width, height, label='Month', prerender=False,
+                                      load=False, name='')
+        return pn.Column(rasterized(explorer.map(), 'mean', width, height), explorer.slider(width))
+    explorer = TimeSliderExplorer(sm_da, dim, render, as_pyramid(sm_da, 'mean'), width, height, label='Month', name='')
+    return pn.Column(explorer.map(), explorer.slider(width))
+
+
+def render_s1_sm(sm_da: DataArray, rasterize: bool = False, **kwargs) -> pn.Column:
     sm_ct = load_cmap(Path(__file__).parent.parent.parent / "resources/colour-tables/ssm-continuous.ct")
     color_opts = dict(
         cmap=sm_ct,
@@ -36,23 +50,13 @@ def render_s1_sm(sm_da: DataArray, **kwargs) -> pn.Column:
         colorbar=True
     )
 
-    class S1SMExplorer(pm.Parameterized):
-        month = pm.Selector([pd.to_datetime(t).date() for t in sm_da.date.values])
-
-        @pm.depends('month')
-        def sm(self):
-            r = sm_da.sel({'date': self.month}, method='nearest').rename('SM')
-            return Image(r).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
-
-        def map(self):
-            return DynamicMap(self.sm)
+    def sm(r: DataArray) -> Image:
+        return Image(r.rename('SM')).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
-    explorer = S1SMExplorer(name='')
-    time_slider = pn.widgets.DiscreteSlider.from_param(explorer.param.month, width=kwargs.get('width', 512))
-    return pn.Column(explorer.map(), time_slider)
+    return _explorer_panel(sm_da, 'date', sm, kwargs, rasterize)
 
 
-def render_ascat_sm(sm_da: DataArray, **kwargs) -> pn.Column:
+def render_ascat_sm(sm_da: DataArray, rasterize: bool = False, **kwargs) -> pn.Column:
     sm_ct = load_cmap(Path(__file__).parent.parent.parent / "resources/colour-tables/ssm-continuous.ct")
     color_opts = dict(
         cmap=sm_ct,
@@ -60,23 +64,13 @@ def render_ascat_sm(sm_da: DataArray, **kwargs) -> pn.Column:
         colorbar=True
     )
 
-    class ASCATSMExplorer(pm.Parameterized):
-        month = pm.Selector([pd.to_datetime(t).date() for t in sm_da.time.values])
+    def sm(r: DataArray) -> Image:
+        return Image(r.rename('SM')).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
-        @pm.depends('month')
-        def sm(self):
-            r = sm_da.sel({'time': self.month}, method='nearest').rename('SM')
-            return Image(r).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
+    return _explorer_panel(sm_da, 'time', sm, kwargs, rasterize)
 
-        def map(self):
-            return DynamicMap(self.sm)
 
-    explorer = ASCATSMExplorer(name='')
-    time_slider = pn.widgets.DiscreteSlider.from_param(explorer.param.month, width=kwargs.get('width', 512))
-    return pn.Column(explorer.map(), time_slider)
-
-
-def render_s1_sm_static(sm_da: DataArray, **kwargs) -> Image:
+def render_s1_sm_static(sm_da: DataArray, rasterize: bool = False, **kwargs) -> Image:
     sm_ct = load_cmap(Path(__file__).parent.parent.parent / "resources/colour-tables/ssm-continuous.ct")
     color_opts = dict(
         cmap=sm_ct,
@@ -84,10 +78,11 @@ def render_s1_sm_static(sm_da: DataArray, **kwargs) -> Image:
         colorbar=True
     )
     r = sm_da.sel({'date': pd.to_datetime(sm_da.date.values[0]).date()}, method='nearest').rename('SM')
-    return Image(r).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
+    image = rasterized(Image(r), 'mean', kwargs.get('width', 512), kwargs.get('height', 512)) if rasterize else Image(r)
+    return image.redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
 
-def render_ascat_sm_static(sm_da: DataArray, **kwargs) -> Image:
+def render_ascat_sm_static(sm_da: DataArray, rasterize: bool = False, **kwargs) -> Image:
     sm_ct = load_cmap(Path(__file__).parent.parent.parent / "resources/colour-tables/ssm-continuous.ct")
     color_opts = dict(
         cmap=sm_ct,
@@ -95,10 +90,11 @@ def render_ascat_sm_static(sm_da: DataArray, **kwargs) -> Image:
         colorbar=True
     )
     r = sm_da.sel({'time': pd.to_datetime(sm_da.time.values[0]).date()}, method='nearest').rename('SM')
-    return Image(r).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
+    image = rasterized(Image(r), 'mean', kwargs.get('width', 512), kwargs.get('height', 512)) if rasterize else Image(r)
+    return image.redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
 
-def render_era5l_swvl(sm_da: DataArray, **kwargs) -> pn.Column:
+def render_era5l_swvl(sm_da: DataArray, rasterize: bool = False, **kwargs) -> pn.Column:
     sm_ct = load_cmap(Path(__file__).parent.parent.parent / "resources/colour-tables/ssm-continuous.ct")
     color_opts = dict(
         cmap=sm_ct,
@@ -106,23 +102,13 @@ def render_era5l_swvl(sm_da: DataArray, **kwargs) -> pn.Column:
         colorbar=True
     )
 
-    class ERA5LSwvl1Explorer(pm.Parameterized):
-        month = pm.Selector([pd.to_datetime(t).date() for t in sm_da.time.values])
-
-        @pm.depends('month')
-        def sm(self):
-            r = sm_da.sel({'time': self.month}, method='nearest').rename('SM')
-            return Image(r).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
-
-        def map(self):
-            return DynamicMap(self.sm)
+    def sm(r: DataArray) -> Image:
+        return Image(r.rename('SM')).redim.range(SM=(0, 1)).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
-    explorer = ERA5LSwvl1Explorer(name='')
-    time_slider = pn.widgets.DiscreteSlider.from_param(explorer.param.month, width=kwargs.get('width', 512))
-    return pn.Column(explorer.map(), time_slider)
+    return _explorer_panel(sm_da, 'time', sm, kwargs, rasterize)
 
 
-def render_corine(lc_da: DataArray, **kwargs):
+def render_corine(lc_da: DataArray, rasterize: bool = False, **kwargs):
     levels = list(range(1, 6))
     colors = ["#e6004d", "#ffff00", "#4dff00", "#a6a6ff", "#80f2e6"]
 
@@ -142,7 +128,14 @@ def render_corine(lc_da: DataArray, **kwargs):
         clipping_colors={'NaN': 'rgba(0, 0, 0, 0)'},
         colorbar_opts={'ticker': ticker, 'formatter': formatter}
     )
-    return Image(lc_da_copy['corine_lc'][0]).opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
+    lc = lc_da_copy['corine_lc'][0]
+    width, height = kwargs.get('width', 512), kwargs.get('height', 512)
+    if rasterize:
+        image = rasterized(Image(lc), 'nearest', width, height)
+    else:
+        pyramid = as_pyramid(lc, 'nearest')
+        image = Image(lc) if pyramid is None else dynamic_image(pyramid, width, height)
+    return image.opts(**color_opts, **kwargs, **zoom, xlabel="longitude", ylabel="latitude")
 
 
 def _load_corine_legend(legend_file: Path) -> List[Tuple[int, str, str]]:
@@ -9,7 +9,8 @@ from shapely.geometry import mapping
 from xarray import DataArray
 from pathlib import Path
 
-from dedl.schedule import DistributedScheduler
+from dedl.reproject import reproject
+from dedl.schedule import AnyExecutor, announce, compute, reproject_on
 
 TARGET_RESOLUTION_IN_M = 500
 RESOURCES = Path(__file__).parent.parent.parent / "resources"
@@ -20,24 +21,27 @@ def normalize(da: DataArray) -> DataArray:
     return (da - da_min) / (da.max() - da_min)
 
 
-def preprocess_s1_sm(sm: DataArray, scheduler: DistributedScheduler) -> DataArray:
+def preprocess_s1_sm(sm: DataArray, executor: AnyExecutor = None) -> DataArray:
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=RuntimeWarning)
-        print(f"Connecting to {scheduler.host}...")
-        print(f"Succeeded!")
-        print(f"processing at {scheduler.worker}")
-        sm_mm = sm.resample(date='15D').mean('date')
-        return normalize(sm_mm).load(scheduler='processes').rio.reproject('EPSG:3857', resampling=Resampling.bilinear)
+        announce(executor)
+        sm_mm = normalize(sm.resample(date='15D').mean('date'))
+        return reproject_on(executor, sm_mm, 'EPSG:3857', resampling=Resampling.bilinear)
 
 
-def preprocess_ascat_sm(sm: DataArray, scheduler: DistributedScheduler) -> DataArray:
+def preprocess_ascat_sm(sm: DataArray, executor: AnyExecutor = None) -> DataArray:
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=RuntimeWarning)
-        print(f"Connecting to {scheduler.host}...")
-        print(f"Succeeded!")
-        print(f"processing at {scheduler.worker}")
+        announce(executor)
         sm.rio.write_nodata(np.nan, inplace=True)
-        sm_mm = sm.resample(time='10D').mean('time')
+        # only the reduction runs on the executor; the swath resampling clips to a shapefile workers do not have
+        sm_mm = compute(executor, sm.resample(time='10D').mean('time')).result()
+        return _ascat_to_web_mercator(sm_mm)
+
+
+def _ascat_to_web_mercator(sm_mm: DataArray) -> DataArray:
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
         e7proj = "+proj=aeqd +lat_0=53 +lon_0=24 +x_0=5837287.81977 +y_0=2121415.69617 +datum=WGS84 +units=m +no_defs"
         geo_trans = [4200000, 200000, 5500000, 1500000]
         area_def = geometry.AreaDefinition("e7", "", "", e7proj,
@@ -55,31 +59,27 @@ def preprocess_ascat_sm(sm: DataArray, scheduler: DistributedScheduler) -> DataA
         sm_area.rio.write_crs(e7proj, inplace=True)
         sm_area.rio.write_transform(Affine.from_gdal(4200000, -6500, 0, 1500000, 0, 6500), inplace=True)
         sm_area.rio.write_nodata(np.nan, inplace=True)
-        sm_area = sm_area.rio.reproject('EPSG:3857', resampling=Resampling.bilinear)
+        sm_area = reproject(sm_area, 'EPSG:3857', resampling=Resampling.bilinear)
         sm_area = clip_dataset_to_shape_file(sm_area, RESOURCES / 'borders/4dmed/catch_med.shp')
         return sm_area.rio.clip_box(7, 37, 18, 46.5, crs='EPSG:4326')
 
 
-def preprocess_era5l_swvl1(sm: DataArray, scheduler: DistributedScheduler) -> DataArray:
+def preprocess_era5l_swvl1(sm: DataArray, executor: AnyExecutor = None) -> DataArray:
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=RuntimeWarning)
-        print(f"Connecting to {scheduler.host}...")
-        print(f"Succeeded!")
-        print(f"processing at {scheduler.worker}")
-        sm_mm = sm.resample(time='15D').mean('time')
-        return normalize(sm_mm).load(scheduler='processes').rio.reproject('EPSG:3857', resampling=Resampling.bilinear)
+        announce(executor)
+        sm_mm = normalize(sm.resample(time='15D').mean('time'))
+        return reproject_on(executor, sm_mm, 'EPSG:3857', resampling=Resampling.bilinear)
 
 
-def preprocess_corine(lc: DataArray, scheduler: DistributedScheduler) -> DataArray:
+def preprocess_corine(lc: DataArray, executor: AnyExecutor = None) -> DataArray:
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=RuntimeWarning)
-        print(f"Connecting to {scheduler.host}...")
-        print(f"Succeeded!")
-        print(f"processing at {scheduler.worker}")
+        announce(executor)
         steps = TARGET_RESOLUTION_IN_M // 100
-        downsampled = lc.coarsen({'latitude': steps, 'longitude': steps}, boundary='trim').median().load()
-        return downsampled.transpose('lc', 'latitude', 'longitude').rio.write_crs('EPSG:4326').rio.reproject(
-            'EPSG:3857')
+        downsampled = lc.coarsen({'latitude': steps, 'longitude': steps}, boundary='trim').median()
+        downsampled = downsampled.transpose('lc', 'latitude', 'longitude').rio.write_crs('EPSG:4326')
+        return reproject_on(executor, downsampled, 'EPSG:3857')
 
 
 def clip_dataset_to_shape_file(ds, clip_shape_file):
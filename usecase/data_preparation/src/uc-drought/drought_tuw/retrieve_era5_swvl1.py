@@ -2,44 +2,16 @@ import argparse
 import rioxarray # noqa
 from datetime import date, datetime
 from pathlib import Path
+from typing import Callable, List, Optional
 
 import cdsapi
 import dask.array
 import numpy as np
 import pandas as pd
-import xarray as xr
 from xarray import Dataset
 
-
-def request_grib(day: date) -> Path:
-    c = cdsapi.Client()
-
-    out_file = f'/tmp/swvl1_era5land_{day.year}{day.month}{day.day}.grib'
-    if Path(out_file).exists():
-        return out_file
-    c.retrieve(
-        'reanalysis-era5-land',
-        {
-            'product_type': 'reanalysis',
-            'format': 'grib',
-            'time': [
-                '00:00', '01:00', '02:00', '03:00',
-                '04:00', '05:00', '06:00', '07:00',
-                '08:00', '09:00', '10:00', '11:00',
-                '12:00', '13:00', '14:00', '15:00',
-                '16:00', '17:00', '18:00', '19:00',
-                '20:00', '21:00', '22:00', '23:00',
-            ],
-            'day': day.day,
-            'month': day.month,
-            'year': day.year,
-            'area': [90, -180, -90, 180],
-
-            'variable': 'swvl1',
-        },
-        out_file)
-
-    return Path(out_file)
+from dedl.cds import MAX_REQUESTS_IN_FLIGHT, TILE_DIMS, Bounds, Window, cache_encoding, empty_tile_coverage, \
+    ensure_tile_coverage, missing_tiles, open_grib, retrieve_days, sync_replica, write_days
 
 
 def create_empty_swvl_zarr_store(path: Path) -> None:
@@ -51,39 +23,40 @@ def create_empty_swvl_zarr_store(path: Path) -> None:
     ds = Dataset({
         'swvl1': (('time', 'latitude', 'longitude'), dummies_f32),
         'covered': (('time',), dummies_bool),
+        'tile_covered': (('time', *TILE_DIMS), empty_tile_coverage(len(days), len(lats), len(lons))),
     }, coords={'time': ('time', days), 'latitude': ('latitude', lats), 'longitude': ('longitude', lons)})
     ds['covered'].rio.write_nodata(0, encoded=True, inplace=True)
     ds.rio.set_spatial_dims('longitude', 'latitude', inplace=True)
     ds.rio.write_crs('EPSG:4326', inplace=True)
-    ds.to_zarr(path, compute=False)
-    ds.drop_vars(('swvl1', 'covered', 'time')).to_zarr(path, mode='a')
+    ds.to_zarr(path, compute=False, encoding=cache_encoding('swvl1', len(lats), len(lons)))
+    ds.drop_vars(('swvl1', 'covered', 'tile_covered', 'time')).to_zarr(path, mode='a')
 
 
-def retrieve_swvl1(zarr: Path, start: date, end: date) -> None:
+def retrieve_swvl1(zarr: Path, start: date, end: date, client_factory: Callable = cdsapi.Client,
+                   max_in_flight: int = MAX_REQUESTS_IN_FLIGHT, replica: Optional[Path] = None,
+                   bounds: Optional[Bounds] = None) -> None:
     if not zarr.exists():
         create_empty_swvl_zarr_store(zarr)
-    cache_ds = xr.open_zarr(zarr)
-    update_cache_covers(cache_ds, zarr, start, end)
+    cache_ds = ensure_tile_coverage(zarr)
+    update_cache_covers(cache_ds, zarr, start, end, client_factory, max_in_flight, bounds)
+    if replica is not None:
+        sync_replica(zarr, replica, start, end, bounds)
+
 
+def update_cache_covers(cache_ds, zarr, start, end, client_factory: Callable = cdsapi.Client,
+                        max_in_flight: int = MAX_REQUESTS_IN_FLIGHT, bounds: Optional[Bounds] = None) -> None:
+    missing = missing_tiles(cache_ds, start, end, bounds)
 
-def update_cache_covers(cache_ds, zarr, start, end) -> None:
-    time_selection = cache_ds['covered'].loc[start:end].load()
-    missing = time_selection.where(time_selection != 1, drop=True).time
-    for missing_day in missing.time:
-        da = xr.open_dataset(request_grib(pd.to_datetime(missing_day.item())),
-                             backend_kwargs=dict(indexpath=''))['swvl1']
-        da = da.mean('time')
+    def write(grib: Path, days: List[date], window: Window) -> None:
+        da = open_grib(grib, 'swvl1')
+        da = da.resample(time='1D').mean()
+        da = da.sel(time=[np.datetime64(d, 'ns') for d in days])
         da.rio.set_spatial_dims('longitude', 'latitude', inplace=True)
         da.rio.write_crs('EPSG:4326', inplace=True)
-        da = da.rio.reproject('EPSG:4326')
-        update_ds = Dataset({'swvl1': (('time', 'latitude', 'longitude'), da.values[None, ...].astype(np.float32)),
-                             'covered': (('time',), np.array([1], dtype=np.uint8))})
-        t_i = find_index(cache_ds, 'time', missing_day)
-        update_ds.to_zarr(zarr, region={
-            'time': slice(t_i, t_i + 1),
-            'latitude': slice(0, len(cache_ds.latitude)),
-            'longitude': slice(0, len(cache_ds.longitude))
-        })
+        da = da.rio.reproject('EPSG:4326').rename({'x': 'longitude', 'y': 'latitude'})
+        write_days(zarr, cache_ds, 'swvl1', da, window)
+
+    retrieve_days(cache_ds, missing, 'swvl1', write, client_factory, max_in_flight=max_in_flight)
 
 
 def to_datetime(start):
@@ -99,5 +72,11 @@ if __name__ == '__main__':
     parser.add_argument('out_zarr', type=Path, help='zarr archive to store restructured data in')
     parser.add_argument('start', type=str, help='Start date i.e. 2022-03-01')
     parser.add_argument('end', type=str, help='End date i.e. 2022-08-31')
+    parser.add_argument('--replica', type=Path, default=None,
+                        help='optional zarr archive kept in sync with long time chunks for time series reads')
+    parser.add_argument('--extent', type=str, default=None,
+                        help='only retrieve the 10 degree tiles within min_x,min_y,max_x,max_y (EPSG:4326)')
     args = parser.parse_args()
-    retrieve_swvl1(args.out_zarr, date.fromisoformat(args.start), date.fromisoformat(args.end))
+    bounds = tuple(map(float, args.extent.split(','))) if args.extent else None
+    retrieve_swvl1(args.out_zarr, date.fromisoformat(args.start), date.fromisoformat(args.end),
+                   replica=args.replica, bounds=bounds)
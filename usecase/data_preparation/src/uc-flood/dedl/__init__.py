@@ -1,3 +1,7 @@
+from pkgutil import extend_path
+
+__path__ = extend_path(__path__, __name__)
+
 from dedl._version import __version__
 from dedl._version import __commit__
 
@@ -0,0 +1,113 @@
+from functools import partial
+from typing import NamedTuple, Sequence
+
+import numpy as np
+import xarray as xr
+from xarray import DataArray
+
+
+def _counts(x, axis):
+    valid = ~np.isnan(x) if x.dtype.kind == 'f' else np.ones_like(x, dtype=bool)
+    positives = (x > 0) & valid
+    return positives.sum(axis=axis, dtype=np.int32), valid.sum(axis=axis, dtype=np.int32)
+
+
+def _majority(x, axis, ties=True, empty=np.nan):
+    positives, n = _counts(x, axis)
+    votes = positives * 2 >= n if ties else positives * 2 > n
+    return np.where(n > 0, votes, empty).astype(np.float32)
+
+
+def _any(x, axis, empty=np.nan):
+    positives, n = _counts(x, axis)
+    return np.where(n > 0, positives > 0, empty).astype(np.float32)
+
+
+def _all(x, axis, empty=np.nan):
+    positives, n = _counts(x, axis)
+    return np.where(n > 0, positives == n, empty).astype(np.float32)
+
+
+def _fraction(x, axis, empty=np.nan):
+    positives, n = _counts(x, axis)
+    return np.where(n > 0, positives / np.maximum(n, 1), empty).astype(np.float32)
+
+
+_REDUCERS = {'majority': _majority, 'any': _any, 'all': _all, 'fraction': _fraction}
+
+
+def _align_chunks(da: DataArray, factor: int, dims: Sequence[str]) -> DataArray:
+    if da.chunks is None:
+        return da
+    chunks = {}
+    for dim in dims:
+        size = da.chunksizes[dim][0]
+        chunks[dim] = max(factor, size // factor * factor)
+    return da.chunk(chunks)
+
+
+def block_reduce(da: DataArray, factor: int, how: str = 'majority', dims: Sequence[str] = ('y', 'x'),
+                 **kwargs) -> DataArray:
+    if how not in _REDUCERS:
+        raise ValueError(f"Unknown reduction {how!r}, expected one of {sorted(_REDUCERS)}")
+    # counting positives per block is a sum, so it streams through memory instead of sorting like a median
+    da = _align_chunks(da, factor, dims)
+    return da.coarsen({d: factor for d in dims}, boundary='trim').reduce(partial(_REDUCERS[how], **kwargs))
+
+
+def majority(da: DataArray, factor: int, ties: bool = True, empty: float = np.nan, **kwargs) -> DataArray:
+    return block_reduce(da, factor, 'majority', ties=ties, empty=empty, **kwargs)
+
+
+def any_of(da: DataArray, factor: int, empty: float = np.nan, **kwargs) -> DataArray:
+    return block_reduce(da, factor, 'any', empty=empty, **kwargs)
+
+
+def all_of(da: DataArray, factor: int, empty: float = np.nan, **kwargs) -> DataArray:
+    return block_reduce(da, factor, 'all', empty=empty, **kwargs)
+
+
+def fraction(da: DataArray, factor: int, empty: float = np.nan, **kwargs) -> DataArray:
+    return block_reduce(da, factor, 'fraction', empty=empty, **kwargs)
+
+
+NODATA = 0
+
+
+class Layer(NamedTuple):
+    data: DataArray
+    code: int
+    threshold: float = 0.0
+
+
+def _composite(*blocks, codes, thresholds, other):
+    # like the stacked nanmax this replaces, a pixel no layer claims is `other`, even without data in any layer
+    out = np.full(blocks[0].shape, other, np.uint8)
+    for block, code, threshold in zip(blocks, codes, thresholds):
+        # NaN compares False, so missing pixels never claim a class
+        np.maximum(out, np.where(block > threshold, np.uint8(code), out), out=out)
+    return out
+
+
+def align_to(da: DataArray, like: DataArray, x_dim: str = 'x', y_dim: str = 'y') -> DataArray:
+    if da.rio.crs is None or like.rio.crs is None:
+        raise ValueError(f"Cannot align {da.name!r} to {like.name!r} without a CRS on both.")
+    if da.rio.crs != like.rio.crs:
+        # rioxarray has no lazy reprojection; only a CRS change pays for an eager warp
+        warped = da.rio.reproject_match(like)
+        return warped.chunk(like.chunksizes) if like.chunks else warped
+    tolerance = max(abs(float(da[d][1] - da[d][0])) for d in (x_dim, y_dim))
+    return da.reindex_like(like, method='nearest', tolerance=tolerance)
+
+
+def composite(layers: Sequence[Layer], other: int = 1, name: str = 'code') -> DataArray:
+    # the highest code wins, so overviews built with a max keep the priority and never cover data with NODATA
+    if any(not NODATA < code < 256 for code in [other] + [l.code for l in layers]):
+        raise ValueError(f"Class codes must lie in 1..255, {NODATA} marks missing data.")
+    base = layers[0].data
+    aligned = [base] + [align_to(layer.data, base) for layer in layers[1:]]
+    combined = xr.apply_ufunc(_composite, *aligned, dask='parallelized', output_dtypes=[np.uint8],
+                              kwargs={'codes': [l.code for l in layers], 'thresholds': [l.threshold for l in layers],
+                                      'other': other})
+    combined = combined.rename(name)
+    return combined.rio.write_crs(base.rio.crs) if base.rio.crs is not None else combined
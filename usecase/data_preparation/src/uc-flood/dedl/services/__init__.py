@@ -1,3 +1,7 @@
+from pkgutil import extend_path
+
+__path__ = extend_path(__path__, __name__)
+
 from dedl.services.discover import Discover
 from dedl.services.quickview import render_flood_extent, render_built_extent, \
     render_streetview
\ No newline at end of file
@@ -1,14 +1,15 @@
 from datetime import date, datetime
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional
 
 import cdsapi
 import dask.array
 import numpy as np
 import pandas as pd
-import xarray as xr
 from xarray import DataArray, Dataset
 
+from dedl.cds import MAX_REQUESTS_IN_FLIGHT, TILE_DIMS, Bounds, Window, cache_encoding, empty_tile_coverage, \
+    ensure_tile_coverage, missing_tiles, open_grib, retrieve_days, sync_replica, write_days
 from dedl.geo_grid import calc_grid_box_area
 from dedl.parameters import Extent
 from dedl.services.common import AccessProtocol
@@ -16,35 +17,6 @@ from dedl.services.common import AccessProtocol
 CACHE_ROOT = Path(__file__).parent.parent.parent.parent.parent / "resources/DEDL/predicted_rainfall.zarr"
 
 
-def request_grib(day: date) -> Path:
-    c = cdsapi.Client()
-
-    out_file = f'/tmp/total_precipitation_era5land_{day.year}{day.month}{day.day}.grib'
-    c.retrieve(
-        'reanalysis-era5-land',
-        {
-            'product_type': 'reanalysis',
-            'format': 'grib',
-            'time': [
-                '00:00', '01:00', '02:00', '03:00',
-                '04:00', '05:00', '06:00', '07:00',
-                '08:00', '09:00', '10:00', '11:00',
-                '12:00', '13:00', '14:00', '15:00',
-                '16:00', '17:00', '18:00', '19:00',
-                '20:00', '21:00', '22:00', '23:00',
-            ],
-            'day': day.day,
-            'month': day.month,
-            'year': day.year,
-            'area': [90, -180, -90, 180],
-
-            'variable': 'total_precipitation',
-        },
-        out_file)
-
-    return Path(out_file)
-
-
 def create_empty_rainfall_zarr_store(path: Path) -> None:
     lats = np.arange(90, -90.1, -0.1)
     lons = np.arange(-180, 180, 0.1)
@@ -55,11 +27,12 @@ def create_empty_rainfall_zarr_store(path: Path) -> None:
     ds = Dataset({
         'tp': (('time', 'latitude', 'longitude'), dummies_f32),
         'covered': (('time',), dummies_bool),
+        'tile_covered': (('time', *TILE_DIMS), empty_tile_coverage(len(days), len(lats), len(lons))),
         'area': (('latitude', 'longitude'), areas)
     }, coords={'time': ('time', days), 'latitude': ('latitude', lats), 'longitude': ('longitude', lons)})
     ds['covered'].rio.write_nodata(0, encoded=True, inplace=True)
-    ds.to_zarr(path, compute=False)
-    ds.drop_vars(('tp', 'covered', 'time')).to_zarr(path, mode='a')
+    ds.to_zarr(path, compute=False, encoding=cache_encoding('tp', len(lats), len(lons)))
+    ds.drop_vars(('tp', 'covered', 'tile_covered', 'time')).to_zarr(path, mode='a')
 
 
 def to_datetime(start):
@@ -71,34 +44,35 @@ def find_index(ds, coord, value):
 
 
 class PredictedRainfall(AccessProtocol):
-    def __init__(self, cache: Optional[Path] = None):
+    def __init__(self, cache: Optional[Path] = None, client_factory: Callable = cdsapi.Client,
+                 max_in_flight: int = MAX_REQUESTS_IN_FLIGHT, replica: Optional[Path] = None):
         self._cache = cache or CACHE_ROOT
+        self._replica = replica
+        self._client_factory = client_factory
+        self._max_in_flight = max_in_flight
 
     def get(self, extent: Extent, start: date, end: Optional[date] = None) -> DataArray:
         if not self._cache.exists():
             create_empty_rainfall_zarr_store(self._cache)
-        cache_ds = xr.open_zarr(self._cache)
-        self._ensure_cache_covers(cache_ds, start, end)
+        cache_ds = ensure_tile_coverage(self._cache)
+        self._ensure_cache_covers(cache_ds, start, end, extent.to_tuple())
+        if self._replica is not None:
+            cache_ds = sync_replica(self._cache, self._replica, start, end, extent.to_tuple())
         selection = cache_ds.sel(time=slice(to_datetime(start), to_datetime(end)),
                                  latitude=slice(extent.max_y, extent.min_y),
                                  longitude=slice(extent.min_x, extent.max_x))
         return selection['tp']
 
-    def _ensure_cache_covers(self, cache_ds, start, end) -> None:
-        time_selection = cache_ds['covered'].loc[start:end].load()
-        missing = time_selection.where(time_selection != 1, drop=True).time
-        for missing_day in missing.time:
-            da = xr.open_dataset(request_grib(pd.to_datetime(missing_day.item())),
-                                 backend_kwargs=dict(indexpath=''))['tp']
-            da = da.sel(time=missing_day).sum('step')
-            update_ds = Dataset({'tp': (('time', 'latitude', 'longitude'), da.values[None, ...].astype(np.float32)),
-                                 'covered': (('time',), np.array([1], dtype=np.uint8))})
-            t_i = find_index(cache_ds, 'time', missing_day)
-            update_ds.to_zarr(self._cache, region={
-                'time': slice(t_i, t_i + 1),
-                'latitude': slice(0, len(cache_ds.latitude)),
-                'longitude': slice(0, len(cache_ds.longitude))
-            })
+    def _ensure_cache_covers(self, cache_ds, start, end, bounds: Optional[Bounds] = None) -> None:
+        missing = missing_tiles(cache_ds, start, end, bounds)
+
+        def write(grib: Path, days: List[date], window: Window) -> None:
+            da = open_grib(grib, 'tp')
+            daily = da.sel(time=[np.datetime64(d, 'ns') for d in days]).sum('step')
+            write_days(self._cache, cache_ds, 'tp', daily, window)
+
+        retrieve_days(cache_ds, missing, 'total_precipitation', write, self._client_factory,
+                      max_in_flight=self._max_in_flight)
 
 
 def accumulate_to_full_days(da: DataArray) -> DataArray:
@@ -2,40 +2,41 @@ import warnings
 
 import matplotlib.colors as clr
 import numpy as np
-import pandas as pd
 import panel as pn
-import param as pm
-import xarray as xr
 from bokeh.models import FuncTickFormatter, FixedTicker
-from holoviews import Image, element, Curve, extension, DynamicMap
+from dask.base import tokenize
+from holoviews import Image, element, Curve, extension
 from rasterio.enums import Resampling
 from xarray import DataArray
 
-from dedl.services.schedule import DistributedScheduler
+from dedl.categorical import Layer, composite, majority
+from dedl.explorer import FrameCache, TimeSliderExplorer
+from dedl.pyramid import as_pyramid, dynamic_image, rasterized
+from dedl.reproject import reproject
+from dedl.schedule import AnyExecutor, announce, reproject_on
 
 extension('bokeh')
 
 TARGET_RESOLUTION_IN_M = 500
+RAIN_CMAP = clr.LinearSegmentedColormap.from_list('custom blue', ['#D3D3D3', '#000080'], N=256)
 
 
-def preprocess_dataset(data_array: DataArray, method: str, scheduler: DistributedScheduler):
+def preprocess_dataset(data_array: DataArray, method: str, executor: AnyExecutor = None):
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=RuntimeWarning)
-        print(f"Connecting to {scheduler.host}...")
+        announce(executor)
         data_array = data_array.squeeze()
         src_res = get_resolution_from_data_array(data_array)
         steps = TARGET_RESOLUTION_IN_M // src_res
-        coarsened = data_array.coarsen({'y': steps, 'x': steps}, boundary='trim')
-        print(f"Succeeded!")
-        print(f"processing at {scheduler.worker}")
         if method == 'median':
-            data_array = (coarsened.median().load(scheduler='processes') > 0).astype('float32')
+            # same result as median > 0 on a binary mask (ties flood, all-NaN blocks are dry), counted instead of sorted
+            data_array = majority(data_array, steps, ties=True, empty=0.0)
         elif method == 'mean':
-            data_array = coarsened.mean().load(scheduler='processes')
+            data_array = data_array.coarsen({'y': steps, 'x': steps}, boundary='trim').mean()
         else:
             raise NotImplementedError(method)
 
-        return data_array.rio.reproject(f"EPSG:3857", nodata=np.nan)
+        return reproject_on(executor, data_array, f"EPSG:3857", nodata=np.nan)
 
 
 def get_resolution_from_data_array(da):
@@ -48,16 +49,24 @@ def get_resolution_from_data_array(da):
     return src_res
 
 
-def render_flood_and_built_extent(flood: DataArray, built: DataArray, colorbar=True, **kwargs) -> None:
-    built = built.rio.reproject_match(flood)
-    combined = xr.zeros_like(flood, dtype=flood.dtype)
-    combined.values = np.nanmax(np.stack([flood.values, ((built > 10) * 2).values]), axis=0)
+def _image(da: DataArray, how: str, rasterize: bool = False, **kwargs):
+    if rasterize:
+        return rasterized(Image(da), how, kwargs.get('width', 512), kwargs.get('height', 512))
+    pyramid = as_pyramid(da, how)
+    if pyramid is None:
+        return Image(da)
+    return dynamic_image(pyramid, kwargs.get('width', 512), kwargs.get('height', 512))
+
+
+def render_flood_and_built_extent(flood: DataArray, built: DataArray, colorbar=True, rasterize=False, **kwargs) -> None:
+    # uint8 codes, built over flooded over other (also where neither layer has data), evaluated block by block
+    combined = composite([Layer(flood, 2), Layer(built, 3, threshold=10)], other=1)
 
     formatter = FuncTickFormatter(code='''
-    return {0.33: 'other', 1.0 : 'flooded', 1.66 : 'built'}
+    return {1.33: 'other', 2.0 : 'flooded', 2.66 : 'built'}
     [tick]
     ''')
-    ticker = FixedTicker(ticks=[0.33, 1.0, 1.66])
+    ticker = FixedTicker(ticks=[1.33, 2.0, 2.66])
 
     color_opts = dict(
         cmap=["#D3D3D3", "rgb(0, 0, 128)", "#FF0000"],
@@ -66,7 +75,8 @@ def render_flood_and_built_extent(flood: DataArray, built: DataArray, colorbar=T
         colorbar_opts={'ticker': ticker, 'formatter': formatter}
     )
 
-    flood_view = Image(combined).opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
+    flood_view = _image(combined, 'max', rasterize, **kwargs).redim.range(code=(1, 3))\
+        .opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
     street_view = element.tiles.StamenTonerRetina()
     return flood_view * street_view.opts(alpha=0.3) 
 
@@ -75,39 +85,48 @@ def render_streetview(flood_view, **kwargs):
     return flood_view.opts(alpha=0, colorbar=False, **kwargs) * street_view
 
 
-def render_rain_prediction(rain_da: DataArray, dem: DataArray, **kwargs):
+_backgrounds = FrameCache(maxsize=4)
+
+
+def _hillshade(dem: DataArray, rasterize: bool = False, **kwargs):
+    def shade():
+        background = dem.copy(deep=True)
+        background = reproject(background, 'EPSG:3857')
+        ls = clr.LightSource(azdeg=315, altdeg=45)
+        background.values[0] = ls.hillshade(background.values[0], vert_exag=0.001)
+        return _image(background[0], 'mean', rasterize, **kwargs).opts(colorbar=False, cmap='gray',
+                                                            clipping_colors={'NaN': '#999999'})
+
+    return _backgrounds.get((tokenize(dem), rasterize, kwargs.get('width'), kwargs.get('height')), shade)
+
+
+def render_rain_prediction(rain_da: DataArray, dem: DataArray, rasterize=False, **kwargs):
     color_opts = dict(
-        cmap=clr.LinearSegmentedColormap.from_list('custom blue', ['#D3D3D3', '#000080'], N=256),
+        cmap=RAIN_CMAP,
         clipping_colors={'NaN': 'rgba(0, 0, 0, 0)', 'min': 'rgba(0, 0, 0, 0)'},
         colorbar=True
     )
 
-    background = dem.copy(deep=True)
-    background = background.rio.reproject('EPSG:3857')
-    ls = clr.LightSource(azdeg=315, altdeg=45)
-    background.values[0] = ls.hillshade(background.values[0], vert_exag=0.001)
-    bg_view = Image(background[0]).opts(colorbar=False, cmap='gray', clipping_colors={'NaN': '#999999'})
-
+    bg_view = _hillshade(dem, rasterize, **kwargs)
     max_rain = rain_da.max().values.item()
 
-    class RainExplorer(pm.Parameterized):
-        time = pm.Selector([pd.to_datetime(t).date() for t in rain_da.time.values])
-
-        @pm.depends('time')
-        def rain(self):
-            r = rain_da.sel({'time': self.time}, method='nearest').rename('rain')
-            return Image(r).redim.range(rain=(0, max_rain))\
-                .opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
+    def rain(r: DataArray):
+        return Image(r.rename('rain')).redim.range(rain=(0, max_rain))\
+            .opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
 
-        def map(self):
-            street_view = element.tiles.StamenTonerRetina()
-            return bg_view * street_view.opts(alpha=0.3) * DynamicMap(self.rain).opts(alpha=0.6)
+    width, height = kwargs.get('width', 512), kwargs.get('height', 512)
+    if rasterize:
+        explorer = TimeSliderExplorer(rain_da, 'time', rain, None, width, height, prerender=False, load=False, name='')
+        rain_view = rasterized(explorer.map(), 'mean', width, height)
+    else:
+        explorer = TimeSliderExplorer(rain_da, 'time', rain, as_pyramid(rain_da, 'mean'), width, height, name='')
+        rain_view = explorer.map()
+    street_view = element.tiles.StamenTonerRetina()
+    rain_map = bg_view * street_view.opts(alpha=0.3) * rain_view.opts(alpha=0.6)
+    return pn.Column(rain_map, explorer.slider(width))
 
-    explorer = RainExplorer(name='')
-    time_slider = pn.widgets.DiscreteSlider.from_param(explorer.param.time, width=kwargs.get('width', 512))
-    return pn.Column(explorer.map(), time_slider)
 
-def render_flood_extent(dataset, **kwargs):
+def render_flood_extent(dataset, rasterize=False, **kwargs):
     # some decorations
     formatter = FuncTickFormatter(code='''
     return {0.25: 'non-flooded', 0.75 : 'flooded'}
@@ -122,13 +141,14 @@ def render_flood_extent(dataset, **kwargs):
         colorbar_opts={'ticker': ticker, 'formatter': formatter}
     )
 
-    flood_view = Image(dataset).opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
+    flood_view = _image(dataset, 'majority', rasterize, **kwargs).opts(**color_opts, **kwargs, xlabel="longitude",
+                                                                         ylabel="latitude")
     street_view = element.tiles.StamenTonerRetina()
 
     return flood_view * street_view.opts(alpha=0.3)
 
 
-def render_built_extent(dataset, **kwargs):
+def render_built_extent(dataset, rasterize=False, **kwargs):
     dataset = dataset.rename('build')
     color_opts = dict(
         cmap="Viridis",
@@ -136,7 +156,7 @@ def render_built_extent(dataset, **kwargs):
         colorbar=True
     )
 
-    build_view = Image(dataset).opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
+    build_view = _image(dataset, 'mean', rasterize, **kwargs).opts(**color_opts, **kwargs, xlabel="longitude", ylabel="latitude")
     street_view = element.tiles.StamenTonerRetina()
 
     return build_view.redim.range(build=(0, 100)) * street_view.opts(alpha=0.3)
@@ -1,18 +1,46 @@
-from typing import List
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+from typing import List, Optional
 
+import dask.array
+import numpy as np
 import xarray as xr
 from eotransform_xarray.transformers.send_to_stream import StreamIn
 from rasterio.enums import Resampling
 from xarray import DataArray
 
+from dedl.reproject import reproject
+
 M_TO_MM = 1000
+BACKINGS = ('memory', 'memmap', 'zarr')
+# time steps close() reads back from the backing store and reprojects together
+CLOSE_BLOCK_STEPS = 24
 
 
 class AccumulatorStreamIter(StreamIn):
-    def __init__(self):
+    def __init__(self, n_steps: Optional[int] = None, backing: str = 'memory', path: Optional[Path] = None):
+        if backing not in BACKINGS:
+            raise ValueError(f"Unknown backing {backing!r}, expected one of {BACKINGS}.")
         self._cum_sum_da: List[DataArray] = []
+        self._n_steps = n_steps
+        self._backing = backing
+        self._path = Path(path) if path is not None else None
+        self._out = None
+        self._tempdir = None
+        self._cleanup = None
+        self._running = None
+        self._template = None
+        self._times = []
 
     def send(self, new_obs: DataArray) -> None:
+        if self._n_steps is None:
+            self._send_to_list(new_obs)
+        else:
+            self._send_in_place(new_obs)
+
+    def _send_to_list(self, new_obs: DataArray) -> None:
         new_obs_mm = new_obs * M_TO_MM
         if len(self._cum_sum_da) == 0:
             self._cum_sum_da.append(new_obs_mm)
@@ -20,8 +48,77 @@ class AccumulatorStreamIter(StreamIn):
             acc_val = new_obs_mm.copy(deep=True, data=new_obs_mm.values + self._cum_sum_da[-1].values)
             self._cum_sum_da.append(acc_val)
 
+    def _send_in_place(self, new_obs: DataArray) -> None:
+        step = new_obs.squeeze('time', drop=True) if 'time' in new_obs.dims else new_obs
+        if self._out is None:
+            self._template = step
+            self._running = np.zeros(step.shape, np.result_type(step.dtype, np.float32))
+            self._out = self._allocate((self._n_steps, *step.shape), self._running.dtype, "accumulated")
+        i = len(self._times)
+        if i >= self._n_steps:
+            raise ValueError(f"Accumulator was sized for {self._n_steps} steps, got step {i + 1}.")
+        self._running += np.asarray(step.values) * M_TO_MM
+        self._out[i] = self._running
+        self._times.append(new_obs['time'].values.reshape(-1)[0])
+
+    def _allocate(self, shape, dtype, name: str):
+        if self._backing == 'memory':
+            return np.empty(shape, dtype)
+        if self._path is None and self._tempdir is None:
+            self._tempdir = Path(tempfile.mkdtemp(prefix="dedl-accumulator-"))
+        directory = self._path or self._tempdir
+        if self._backing == 'memmap':
+            return np.lib.format.open_memmap(directory / f"{name}.npy", mode='w+', dtype=dtype, shape=shape)
+        import zarr
+        return zarr.open(str(directory / f"{name}.zarr"), mode='w', shape=shape, dtype=dtype,
+                         chunks=(1, *shape[1:]))
+
+    def _read(self, store, n: int):
+        return dask.array.from_zarr(store)[:n] if self._backing == 'zarr' else store[:n]
+
+    def _accumulated(self) -> DataArray:
+        if self._n_steps is None:
+            return xr.concat(self._cum_sum_da, dim='time')
+        n = len(self._times)
+        return xr.DataArray(self._read(self._out, n), coords={'time': self._times, **self._template.coords},
+                            dims=('time', *self._template.dims), name=self._template.name,
+                            attrs=self._template.attrs)
+
     def close(self) -> DataArray:
-        da = xr.concat(self._cum_sum_da, dim='time')
-        da.rio.write_nodata(0, inplace=True)
-        da.rio.write_crs('EPSG:4326', inplace=True)
-        return da.rio.reproject('EPSG:3857', resolution=500, resampling=Resampling.bilinear)
+        accumulated = self._accumulated()
+        if self._n_steps is None:
+            return to_web_mercator(accumulated)
+        try:
+            return self._project(accumulated)
+        finally:
+            self._out = None
+            if self._tempdir is not None:
+                if self._cleanup is None:
+                    shutil.rmtree(self._tempdir, ignore_errors=True)
+                elif self._backing == 'zarr':
+                    shutil.rmtree(self._tempdir / "accumulated.zarr", ignore_errors=True)
+                else:
+                    (self._tempdir / "accumulated.npy").unlink(missing_ok=True)
+                self._tempdir = None
+
+    def _project(self, accumulated: DataArray) -> DataArray:
+        # block by block into a web-mercator cube preallocated in the same backing, so neither cube is copied whole
+        n = accumulated.sizes['time']
+        out = first = None
+        for i in range(0, n, CLOSE_BLOCK_STEPS):
+            block = to_web_mercator(accumulated.isel(time=slice(i, i + CLOSE_BLOCK_STEPS)))
+            if out is None:
+                first = block.isel(time=0, drop=True)
+                out = self._allocate((n, *first.shape), block.dtype, "web_mercator")
+                if self._tempdir is not None:
+                    # the projected cube is read from the temp dir, so the dir goes once nothing references the cube
+                    self._cleanup = weakref.finalize(out, shutil.rmtree, self._tempdir, True)
+            out[i:i + block.sizes['time']] = block.values
+        return xr.DataArray(self._read(out, n), coords={'time': accumulated['time'].values, **first.coords},
+                            dims=('time', *first.dims), name=first.name, attrs=first.attrs)
+
+
+def to_web_mercator(da: DataArray) -> DataArray:
+    da.rio.write_nodata(0, inplace=True)
+    da.rio.write_crs('EPSG:4326', inplace=True)
+    return reproject(da, 'EPSG:3857', resolution=500, resampling=Resampling.bilinear)
@@ -1,44 +1,148 @@
+import os
+import time
 import warnings
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from typing import Tuple, Iterable
+from pathlib import Path
+from typing import Tuple, Iterable, Optional, List
 
-import pandas as pd
 from eotransform.protocol.transformer import Transformer
 from eotransform.sinks.sink_to_progress_report import SinkToProgressReport
-from eotransform.streamed_process import streamed_process
 from eotransform.transformers.compose import Compose
-from eotransform_xarray.transformers.send_to_stream import SendToStream
+from eotransform_xarray.transformers.send_to_stream import SendToStream, StreamIn
 from eotransform_xarray.transformers.squeeze import Squeeze
 from eotransform_xarray.transformers.to_dataset import ToDataset
 from tqdm import tqdm
 from xarray import DataArray
 
-from dedl.services.schedule import DistributedScheduler
-from flood_rain_acc_tuw.accumulator import AccumulatorStreamIter
+from dedl.schedule import DistributedScheduler
+from flood_rain_acc_tuw.accumulator import AccumulatorStreamIter, M_TO_MM, to_web_mercator
+from flood_rain_acc_tuw.staged import DEFAULT_QUEUE_SIZE, PipelineReport, StageStats, staged_process
+from flood_rain_acc_tuw.transformers.cumulative_sum import CumulativeSum
+from flood_rain_acc_tuw.transformers.scale import Scale
 
+DEFAULT_READ_AHEAD = 4
 
-def accum_rain_predictions(predicted_rain: DataArray, scheduler: DistributedScheduler):
+
+def accum_rain_predictions(predicted_rain: DataArray, scheduler: DistributedScheduler, backing: str = 'memory',
+                           path: Optional[Path] = None, read_ahead: int = DEFAULT_READ_AHEAD,
+                           max_read_ahead_bytes: Optional[int] = None, parallel: bool = False,
+                           workers: Optional[int] = None, queue_size: int = DEFAULT_QUEUE_SIZE,
+                           report: Optional[PipelineReport] = None, report_path: Optional[Path] = None):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
         print(f"Connecting to {scheduler.host}...")
-        acc_process, acc_stream = make_rain_accumulation_process()
+        if parallel:
+            # the whole horizon as one chunk-parallel scan instead of folding step after step
+            print(f"processing at {scheduler.worker}")
+            accumulated = make_parallel_rain_accumulation_process()(predicted_rain)
+            return to_web_mercator(accumulated.compute()).rio.write_crs('EPSG:4326')
+
+        report = report if report is not None else PipelineReport()
+        report.settings.update(read_ahead=read_ahead, max_read_ahead_bytes=max_read_ahead_bytes, backing=backing)
+        stages, acc_stream = rain_accumulation_stages(predicted_rain.sizes['time'], backing, path, report)
         print("Succeeded!")
-        with ThreadPoolExecutor(max_workers=3) as executor, \
-                tqdm(desc=f"processing at {scheduler.worker}", total=len(predicted_rain)) as reporter:
-            streamed_process(per_time_step(predicted_rain), acc_process, SinkToProgressReport(reporter), executor)
+        with tqdm(desc=f"processing at {scheduler.worker}", total=len(predicted_rain)) as reporter:
+            steps = per_time_step(predicted_rain, read_ahead, max_read_ahead_bytes, workers, report)
+            staged_process(steps, stages, SinkToProgressReport(reporter), queue_size, report)
+        if report_path is not None:
+            report.save(report_path)
         return acc_stream.close().rio.write_crs('EPSG:4326')
 
 
-def make_rain_accumulation_process() \
-        -> Tuple[Transformer, AccumulatorStreamIter]:
-    accumulator_stream = AccumulatorStreamIter()
+class _TimedStream(StreamIn):
+    def __init__(self, stream: StreamIn, stats: StageStats):
+        self._stream = stream
+        self._stats = stats
+
+    def send(self, x: DataArray) -> None:
+        self._stats.timed(self._stream.send, x)
+
+    def close(self):
+        return self._stream.close()
+
+
+def rain_accumulation_stages(n_steps: Optional[int] = None, backing: str = 'memory', path: Optional[Path] = None,
+                             report: Optional[PipelineReport] = None) \
+        -> Tuple[List[Tuple[str, Transformer]], AccumulatorStreamIter]:
+    accumulator_stream = AccumulatorStreamIter(n_steps, backing, path)
+    stream = accumulator_stream if report is None else _TimedStream(accumulator_stream, report.stage('accumulate', parent='send_to_stream'))
+    return [
+        ('to_dataset', ToDataset('rain')),
+        ('send_to_stream', SendToStream(stream, 'rain'))
+    ], accumulator_stream
+
+
+def make_rain_accumulation_process(n_steps: Optional[int] = None, backing: str = 'memory',
+                                   path: Optional[Path] = None) -> Tuple[Transformer, AccumulatorStreamIter]:
+    stages, accumulator_stream = rain_accumulation_stages(n_steps, backing, path)
+    return Compose([stage for _, stage in stages]), accumulator_stream
+
+
+def make_parallel_rain_accumulation_process() -> Transformer:
     return Compose([
-        ToDataset('rain'),
-        SendToStream(accumulator_stream, 'rain')
-    ]), accumulator_stream
+        Scale(M_TO_MM),
+        CumulativeSum('time')
+    ])
+
+
+def per_time_step(da: DataArray, read_ahead: int = DEFAULT_READ_AHEAD, max_bytes: Optional[int] = None,
+                  workers: Optional[int] = None, report: Optional[PipelineReport] = None) -> Iterable[DataArray]:
+    n = da.sizes['time']
+    step_bytes = da.isel(time=slice(0, 1)).nbytes
+    depth = max(1, min(read_ahead, max_bytes // max(step_bytes, 1) if max_bytes is not None else read_ahead))
+    # loaded and in-flight steps together never exceed the depth, so neither can the loaders
+    max_loaders = min(workers or (os.cpu_count() or 1) + 4, depth)
+    # auto mode starts with one loader and adds one while the chain still waits for its steps, until a loader more
+    # no longer shortens the wait
+    loaders = max_loaders if workers else 1
+    growing = workers is None and loaders < max_loaders
+    # the reader waits on the loaders, so their time is nested in its own
+    stats = report.stage('load', parent='read') if report is not None else None
+
+    def load(i: int) -> DataArray:
+        step = da.isel(time=slice(i, i + 1))
+        return stats.timed(DataArray.load, step) if stats is not None else step.load()
+
+    pool = ThreadPoolExecutor(max_loaders, thread_name_prefix="per-time-step-reader")
+    pending = deque()
+    submitted = 0
 
+    def fill():
+        nonlocal submitted
+        while submitted < n and len(pending) < depth and sum(not f.done() for f in pending) < loaders:
+            pending.append(pool.submit(load, submitted))
+            submitted += 1
 
-def per_time_step(da: DataArray) -> Iterable[DataArray]:
-    for t in da.time:
-        yield da.sel(time=[pd.to_datetime(t.item())]).load()
+    yielded, waited, measured, previous = 0, 0.0, 0, None
+    try:
+        while pending or submitted < n:
+            fill()
+            if stats is not None:
+                stats.record_queue(sum(f.done() for f in pending))
+            head = pending.popleft()
+            ready = head.done()
+            start = time.perf_counter()
+            step = head.result()
+            # the first step is always a cold read, so it says nothing about the loaders
+            if growing and yielded:
+                waited += 0.0 if ready else time.perf_counter() - start
+                measured += 1
+                # judge each loader count over as many steps as it has loaders
+                if measured >= loaders:
+                    mean_wait = waited / measured
+                    if previous is not None and mean_wait >= previous:
+                        loaders -= 1
+                        growing = False
+                    elif mean_wait > 0:
+                        previous = mean_wait
+                        loaders += 1
+                        growing = loaders < max_loaders
+                    waited, measured = 0.0, 0
+            yielded += 1
+            yield step
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if report is not None:
+            report.settings['loaders'] = loaders
@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_QUEUE_SIZE = 2
+_END = object()
+
+
+def _nbytes(x: Any) -> int:
+    return int(getattr(x, 'nbytes', 0) or 0)
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    bytes: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    starved_seconds: float = 0.0
+    blocked_seconds: float = 0.0
+    max_queue_depth: int = 0
+    queue_depth_total: int = 0
+    # time with at least one item in flight, so concurrent calls (e.g. parallel loaders) are not summed
+    busy_seconds: float = 0.0
+    # a stage that runs inside another one, whose busy time is then not the outer stage's own
+    parent: Optional[str] = None
+    _active: int = field(default=0, repr=False, compare=False)
+    _since: float = field(default=0.0, repr=False, compare=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, wall: float, cpu: float, nbytes: int = 0) -> None:
+        with self._lock:
+            self.items += 1
+            self.bytes += nbytes
+            self.wall_seconds += wall
+            self.cpu_seconds += cpu
+
+    def record_queue(self, depth: int, blocked: float = 0.0) -> None:
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self.queue_depth_total += depth
+            self.blocked_seconds += blocked
+
+    def begin(self) -> None:
+        with self._lock:
+            if self._active == 0:
+                self._since = time.perf_counter()
+            self._active += 1
+
+    def end(self) -> None:
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self.busy_seconds += time.perf_counter() - self._since
+
+    def timed(self, func: Callable, x: Any) -> Any:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self.begin()
+        try:
+            y = func(x)
+        finally:
+            self.end()
+        self.record(time.perf_counter() - wall, time.thread_time() - cpu, _nbytes(y))
+        return y
+
+    def as_dict(self) -> dict:
+        d = {f.name: getattr(self, f.name) for f in fields(self) if not f.name.startswith('_')}
+        d['items_per_second'] = self.items / self.wall_seconds if self.wall_seconds else None
+        d['bytes_per_second'] = self.bytes / self.wall_seconds if self.wall_seconds else None
+        d['mean_queue_depth'] = self.queue_depth_total / self.items if self.items else 0.0
+        return d
+
+
+@dataclass
+class PipelineReport:
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    elapsed_seconds: float = 0.0
+    settings: dict = field(default_factory=dict)
+
+    def stage(self, name: str, parent: Optional[str] = None) -> StageStats:
+        stats = self.stages.setdefault(name, StageStats(name))
+        if parent is not None:
+            stats.parent = parent
+        return stats
+
+    def exclusive_seconds(self, name: str) -> float:
+        nested = sum(s.busy_seconds for s in self.stages.values() if s.parent == name)
+        return max(0.0, self.stages[name].busy_seconds - nested)
+
+    @property
+    def bottleneck(self) -> Optional[str]:
+        busy = {name: self.exclusive_seconds(name) for name, s in self.stages.items() if s.items}
+        return max(busy, key=busy.get) if busy else None
+
+    def as_dict(self) -> dict:
+        return {'elapsed_seconds': self.elapsed_seconds, 'bottleneck': self.bottleneck, 'settings': self.settings,
+                'stages': [dict(s.as_dict(), exclusive_seconds=self.exclusive_seconds(name))
+                           for name, s in self.stages.items()]}
+
+    def save(self, path: Path) -> None:
+        Path(path).write_text(json.dumps(self.as_dict(), indent=2, default=str))
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _put(q: Queue, item, stats: StageStats, cancel: threading.Event) -> None:
+    start = time.perf_counter()
+    while True:
+        if cancel.is_set():
+            raise _Cancelled()
+        try:
+            q.put(item, timeout=0.1)
+            break
+        except Full:
+            pass
+    stats.record_queue(q.qsize(), time.perf_counter() - start)
+
+
+def _get(q: Queue, stats: StageStats, cancel: threading.Event):
+    start = time.perf_counter()
+    while True:
+        if cancel.is_set():
+            raise _Cancelled()
+        try:
+            item = q.get(timeout=0.1)
+            break
+        except Empty:
+            pass
+    stats.starved_seconds += time.perf_counter() - start
+    return item
+
+
+def staged_process(source: Iterable, stages: Sequence[Tuple[str, Callable]], sink: Callable,
+                   queue_size: int = DEFAULT_QUEUE_SIZE, report: Optional[PipelineReport] = None) -> PipelineReport:
+    # one thread per stage and a bounded queue between neighbours, a slow stage holds back the ones before it
+    report = report if report is not None else PipelineReport()
+    report.settings.setdefault('queue_size', queue_size)
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    cancel = threading.Event()
+    errors: List[BaseException] = []
+
+    def fail(e: BaseException) -> None:
+        if not isinstance(e, _Cancelled):
+            errors.append(e)
+        cancel.set()
+
+    def read() -> None:
+        stats = report.stage('read')
+        try:
+            items = iter(source)
+            while True:
+                wall, cpu = time.perf_counter(), time.thread_time()
+                stats.begin()
+                try:
+                    item = next(items, _END)
+                finally:
+                    stats.end()
+                if item is _END:
+                    break
+                stats.record(time.perf_counter() - wall, time.thread_time() - cpu, _nbytes(item))
+                _put(queues[0], item, stats, cancel)
+            _put(queues[0], _END, stats, cancel)
+        except BaseException as e:
+            fail(e)
+
+    def run(name: str, func: Callable, inbox: Queue, outbox: Optional[Queue]) -> None:
+        stats = report.stage(name)
+        try:
+            while True:
+                item = _get(inbox, stats, cancel)
+                if item is _END:
+                    break
+                y = stats.timed(func, item)
+                if outbox is not None:
+                    _put(outbox, y, stats, cancel)
+            if outbox is not None:
+                _put(outbox, _END, stats, cancel)
+        except BaseException as e:
+            fail(e)
+
+    workers = [threading.Thread(target=read, name="stage-read", daemon=True)]
+    for i, (name, func) in enumerate(stages):
+        workers.append(threading.Thread(target=run, args=(name, func, queues[i], queues[i + 1]),
+                                        name=f"stage-{name}", daemon=True))
+    workers.append(threading.Thread(target=run, args=('sink', sink, queues[-1], None), name="stage-sink", daemon=True))
+
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    report.elapsed_seconds += time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return report
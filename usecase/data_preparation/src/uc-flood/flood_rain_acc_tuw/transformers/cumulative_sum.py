@@ -0,0 +1,40 @@
+import dask.array
+import numpy as np
+import xarray as xr
+from eotransform_xarray.transformers import TransformerOfDataArray
+from xarray import DataArray
+
+
+def _exclusive_cumsum(totals: np.ndarray, axis: int) -> np.ndarray:
+    return np.cumsum(totals, axis=axis) - totals
+
+
+def _add_carry(block: np.ndarray, carry: np.ndarray) -> np.ndarray:
+    return block + carry
+
+
+def cumulative_sum(x, axis: int = 0):
+    if not isinstance(x, dask.array.Array):
+        return np.cumsum(x, axis=axis)
+    axis = axis % x.ndim
+    # 1. every chunk scans itself, all in parallel
+    local = x.map_blocks(np.cumsum, axis=axis, dtype=np.cumsum(np.zeros(1, x.dtype)).dtype)
+    if local.numblocks[axis] == 1:
+        return local
+    # 2. the chunk totals are one slice per chunk, small enough to scan in a single task
+    ends = np.cumsum(local.chunks[axis]) - 1
+    totals = dask.array.take(local, ends, axis=axis).rechunk({axis: -1})
+    carry = totals.map_blocks(_exclusive_cumsum, axis=axis, dtype=local.dtype).rechunk({axis: 1})
+    # 3. each chunk adds the carry of the chunks before it, again in parallel
+    index = tuple(range(x.ndim))
+    return dask.array.blockwise(_add_carry, index, local, index, carry, index, dtype=local.dtype,
+                                align_arrays=False, adjust_chunks={axis: local.chunks[axis]})
+
+
+class CumulativeSum(TransformerOfDataArray):
+    def __init__(self, dim: str = 'time'):
+        self._dim = dim
+
+    def __call__(self, x: DataArray) -> DataArray:
+        return xr.apply_ufunc(cumulative_sum, x, input_core_dims=[[self._dim]], output_core_dims=[[self._dim]],
+                              kwargs={'axis': -1}, dask='allowed', keep_attrs=True).transpose(*x.dims)